@@ -0,0 +1,70 @@
+"""
+Measure incremental formatting of a large document after a one-paragraph edit, compared with
+formatting it from scratch.
+
+Usage: python benchmarks/incremental.py [-n REPEAT] [--copies N] [FILE]
+
+The document is made of N copies of FILE (default `sample.rst`), with target names made unique.
+"""
+
+import argparse
+import os
+import re
+import time
+import warnings
+
+from rstfmt import rst_extras, rstfmt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_document(text: str, copies: int) -> str:
+    return "\n".join(
+        re.sub(r"^\.\. _([^:]+):", rf".. _\g<1>{i}:", text, flags=re.M) for i in range(copies)
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--repeat", type=int, default=5)
+    parser.add_argument("--copies", type=int, default=60)
+    parser.add_argument("file", nargs="?", default=os.path.join(ROOT, "sample.rst"))
+    args = parser.parse_args()
+
+    warnings.simplefilter("ignore")
+    rst_extras.register()
+
+    with open(args.file) as f:
+        doc = make_document(f.read(), args.copies)
+
+    # Insert a word at the start of a paragraph in the middle of the document.
+    lines = doc.splitlines(keepends=True)
+    i = next(
+        i
+        for i in range(len(lines) // 2, len(lines))
+        if lines[i][:1].isalpha() and not lines[i - 1].strip() and lines[i + 1][:1].isalpha()
+    )
+    edited = "".join(lines[:i] + ["Edited " + lines[i]] + lines[i + 1 :])
+
+    t0 = time.perf_counter()
+    for _ in range(args.repeat):
+        expected = rstfmt.format_node(72, rstfmt.parse_string(edited))
+    full = (time.perf_counter() - t0) / args.repeat
+
+    total = 0.0
+    for _ in range(args.repeat):
+        inc = rstfmt.IncrementalFormatter(72)
+        inc.format(doc)
+        t0 = time.perf_counter()
+        result = inc.format(edited)
+        total += time.perf_counter() - t0
+        assert result == expected, "incremental result differs from full formatting"
+    incremental = total / args.repeat
+
+    print(f"{len(lines)} lines, {args.repeat} repetitions")
+    print(f"full:        {1000 * full:8.1f} ms")
+    print(f"incremental: {1000 * incremental:8.1f} ms ({full / incremental:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
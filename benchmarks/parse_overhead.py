@@ -0,0 +1,62 @@
+"""
+Measure the per-call cost of `rstfmt.parse_string` with and without reusing the parsing context.
+
+Usage: python benchmarks/parse_overhead.py [-n REPEAT] [FILE...]
+
+With no files, runs over `tests/*.rst`.
+"""
+
+import argparse
+import glob
+import os
+import time
+import warnings
+from typing import Callable, List
+
+from rstfmt import rst_extras, rstfmt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def fresh_parse(s: str) -> None:
+    # Equivalent to the old behavior of building the settings and parser for every call.
+    rstfmt.preproc(rstfmt.ParseContext().parse(s))
+
+
+def time_per_call(func: Callable[[str], object], texts: List[str], repeat: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts:
+            func(text)
+    return (time.perf_counter() - t0) / (repeat * len(texts))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--repeat", type=int, default=20)
+    parser.add_argument("files", nargs="*")
+    args = parser.parse_args()
+
+    warnings.simplefilter("ignore", DeprecationWarning)
+    rst_extras.register()
+
+    files = args.files or sorted(glob.glob(os.path.join(ROOT, "tests", "*.rst")))
+    texts = []
+    for fn in files:
+        with open(fn) as f:
+            texts.append(f.read())
+
+    # Warm up both paths so one-time import and registration costs aren't counted.
+    fresh_parse(texts[0])
+    rstfmt.parse_string(texts[0])
+
+    before = time_per_call(fresh_parse, texts, args.repeat)
+    after = time_per_call(rstfmt.parse_string, texts, args.repeat)
+    print(f"{len(texts)} files, {args.repeat} repetitions")
+    print(f"fresh context:  {1000 * before:7.3f} ms/call")
+    print(f"reused context: {1000 * after:7.3f} ms/call")
+    print(f"saved:          {1000 * (before - after):7.3f} ms/call ({before / after:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Measure rstfmt's startup cost: the wall time of fresh interpreters importing rstfmt and formatting a
+small document.
+
+Usage: python benchmarks/startup.py [-n REPEAT] [--importtime]
+
+With --importtime, also print the slowest modules according to `python -X importtime`.
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from typing import List, Tuple
+
+SCENARIOS = [
+    ("interpreter", "pass"),
+    ("import", "import rstfmt.__main__"),
+    (
+        "register",
+        "import rstfmt.__main__; from rstfmt import rst_extras; rst_extras.register()",
+    ),
+    (
+        "format (docutils only)",
+        "from rstfmt import rst_extras, rstfmt; rst_extras.register();"
+        " rstfmt.format_node(72, rstfmt.parse_string('Some *text*.\\n\\n.. note:: A note.\\n'))",
+    ),
+    (
+        "format (Sphinx roles)",
+        "from rstfmt import rst_extras, rstfmt; rst_extras.register();"
+        " rstfmt.format_node(72, rstfmt.parse_string('See :func:`f` and :ref:`x`.\\n'))",
+    ),
+    (
+        "format (Python code)",
+        "from rstfmt import rstfmt;"
+        " rstfmt.format_node(72, rstfmt.parse_string('.. code:: python\\n\\n   x = 1\\n'))",
+    ),
+]
+
+
+def time_run(code: str) -> float:
+    t0 = time.perf_counter()
+    subprocess.run([sys.executable, "-W", "ignore", "-c", code], check=True)
+    return time.perf_counter() - t0
+
+
+def slowest_imports(code: str, n: int) -> List[Tuple[int, str]]:
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stderr=subprocess.PIPE,
+        encoding="utf-8",
+        check=True,
+    )
+    results = []
+    for line in proc.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            results.append((int(parts[1]), parts[2].rstrip()))
+    return sorted(results, reverse=True)[:n]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--repeat", type=int, default=10)
+    parser.add_argument("--importtime", action="store_true")
+    args = parser.parse_args()
+
+    for name, code in SCENARIOS:
+        times = [time_run(code) for _ in range(args.repeat)]
+        print(f"{name:24} median {1000 * statistics.median(times):7.1f} ms")
+
+    if args.importtime:
+        print()
+        for us, module in slowest_imports(SCENARIOS[-1][1], 15):
+            print(f"{us / 1000:7.1f} ms {module}")
+
+
+if __name__ == "__main__":
+    main()
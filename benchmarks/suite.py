@@ -0,0 +1,275 @@
+"""
+Time each phase of formatting separately: parsing, preprocessing, formatting the tree, and running
+each code formatter.
+
+Usage: python benchmarks/suite.py [-n REPEAT] [--scale N] [--json FILE] [--baseline FILE]
+                                  [--threshold FRACTION] [-k PATTERN]
+
+The phases run over the test corpus (`tests/*.rst`, `README.rst` and `sample.rst`) as a whole and
+over some larger synthetic documents, whose size is controlled by --scale. Code formatters are timed
+on the code blocks found in those documents, with their results cached, so the format phase doesn't
+include them.
+
+With --json, the results are also written to FILE, which can later be passed as --baseline to
+compare against. The exit status is 1 if any benchmark got slower than the baseline by more than the
+threshold (default 0.1, i.e., 10%).
+"""
+
+import argparse
+import fnmatch
+import glob
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import warnings
+from typing import Callable, Dict, List, Optional, Tuple
+
+import docutils
+
+from rstfmt import cache, rst_extras, rstfmt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WIDTH = 72
+
+Timer = Callable[[], float]
+
+
+def read(fn: str) -> str:
+    with open(fn) as f:
+        return f.read()
+
+
+def corpus() -> List[str]:
+    files = sorted(glob.glob(os.path.join(ROOT, "tests", "*.rst")))
+    files += [os.path.join(ROOT, "README.rst"), os.path.join(ROOT, "sample.rst")]
+    return [read(fn) for fn in files]
+
+
+def synthetic_prose(scale: int) -> str:
+    lipsum = read(os.path.join(ROOT, "tests", "lipsum.rst"))
+    return "\n".join(lipsum for _ in range(scale))
+
+
+def synthetic_targets(scale: int) -> str:
+    # Lots of references and targets, which exercises the matching and sorting in preprocessing.
+    parts = []
+    for i in range(20 * scale):
+        parts.append(f"See `link {i}`_ and `the other <other{i}_>`_ and `anon`__.\n\n")
+        parts.append(f".. _link {i}: https://example.com/{i}\n")
+        parts.append(f".. _other{i}: https://example.com/other/{i}\n")
+        parts.append("__ https://example.com/anonymous\n\n")
+    return "".join(parts)
+
+
+def synthetic_nested(scale: int) -> str:
+    # Deeply nested lists and block quotes, for the recursive parts of formatting.
+    parts = []
+    for _ in range(5 * scale):
+        for depth in range(12):
+            indent = "  " * depth
+            parts.append(f"{indent}- Item at depth {depth} with *some* **inline** ``markup``.\n\n")
+    return "".join(parts)
+
+
+def synthetic_code(scale: int) -> str:
+    parts = []
+    for i in range(10 * scale):
+        parts.append(
+            f".. code-block:: python\n\n"
+            f"   def f{i}(a,b = {i}):\n"
+            f"       return {{'a':a,'b':[b,b+1 ,b+2]}}\n\n"
+            f".. code-block:: go\n\n"
+            f"   func f{i}() int {{\n"
+            f"   return {i}\n"
+            f"   }}\n\n"
+            f".. code-block:: rust\n\n"
+            f"   fn f{i}() -> i32 {{ {i} }}\n\n"
+        )
+    return "".join(parts)
+
+
+def documents(scale: int) -> Dict[str, List[str]]:
+    return {
+        "corpus": corpus(),
+        "prose": [synthetic_prose(scale)],
+        "targets": [synthetic_targets(scale)],
+        "nested": [synthetic_nested(scale)],
+        "code": [synthetic_code(scale)],
+    }
+
+
+def parse(text: str) -> docutils.nodes.document:
+    return rstfmt.get_parse_context().parse(text)
+
+
+def time_phases(texts: List[str]) -> Dict[str, Timer]:
+    # Each timer runs the phase once over all the texts, on fresh trees so nothing carries over.
+    def time_parse() -> float:
+        t0 = time.perf_counter()
+        for text in texts:
+            parse(text)
+        return time.perf_counter() - t0
+
+    def time_preproc() -> float:
+        trees = [parse(text) for text in texts]
+        t0 = time.perf_counter()
+        for tree in trees:
+            rstfmt.preproc(tree)
+        return time.perf_counter() - t0
+
+    def time_format() -> float:
+        trees = [rstfmt.parse_string(text) for text in texts]
+        t0 = time.perf_counter()
+        for tree in trees:
+            rstfmt.format_node(WIDTH, tree)
+        return time.perf_counter() - t0
+
+    return {"parse": time_parse, "preproc": time_preproc, "format": time_format}
+
+
+def code_blocks(texts: List[str]) -> Dict[str, List[str]]:
+    blocks: Dict[str, List[str]] = {}
+    for text in texts:
+        for node in rstfmt.parse_string(text).traverse(docutils.nodes.literal_block):
+            lang = rstfmt.code_block_language(node)
+            if rstfmt.has_code_formatter(lang):
+                blocks.setdefault(lang, []).append(node.astext())  # type: ignore
+    return blocks
+
+
+def time_code(lang: str, blocks: List[str]) -> Optional[Timer]:
+    formatter = getattr(rstfmt.CodeFormatters, lang)
+    # Leave out formatters that can't run here at all, like a missing gofmt, but keep the ones that
+    # just reject some of the blocks.
+    failures = 0
+    for code in blocks:
+        try:
+            formatter(code)
+        except rstfmt.CodeFormatError:
+            failures += 1
+    if failures == len(blocks):
+        return None
+
+    def run() -> float:
+        t0 = time.perf_counter()
+        for code in blocks:
+            try:
+                formatter(code)
+            except rstfmt.CodeFormatError:
+                pass
+        return time.perf_counter() - t0
+
+    return run
+
+
+def benchmarks(scale: int) -> List[Tuple[str, Timer]]:
+    docs = documents(scale)
+    result = []
+    for doc_name, texts in docs.items():
+        for phase, timer in time_phases(texts).items():
+            result.append((f"{phase}/{doc_name}", timer))
+    blocks = code_blocks([text for texts in docs.values() for text in texts])
+    for lang, codes in sorted(blocks.items()):
+        code_timer = time_code(lang, codes)
+        if code_timer is None:
+            print(f"skipping code/{lang}: the formatter failed on every block", file=sys.stderr)
+        else:
+            result.append((f"code/{lang}", code_timer))
+    return result
+
+
+def run(timer: Timer, repeat: int) -> Dict[str, float]:
+    times = [timer() for _ in range(repeat)]
+    return {"median": statistics.median(times), "min": min(times)}
+
+
+def compare(
+    results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], threshold: float
+) -> List[str]:
+    """
+    Print the results next to the baseline, returning the names of the benchmarks that regressed.
+
+    The comparison uses the fastest run of each benchmark, which is much less affected by whatever
+    else the machine is doing than the median.
+    """
+    regressions = []
+    print(f"{'benchmark':24} {'min':>10} {'median':>10} {'baseline':>10} {'change':>8}")
+    for name, r in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(
+                f"{name:24} {1000 * r['min']:8.2f}ms {1000 * r['median']:8.2f}ms {'-':>10} {'-':>8}"
+            )
+            continue
+        change = r["min"] / base["min"] - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(
+            f"{name:24} {1000 * r['min']:8.2f}ms {1000 * r['median']:8.2f}ms"
+            f" {1000 * base['min']:8.2f}ms"
+            f" {100 * change:+7.1f}%{flag}"
+        )
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--repeat", type=int, default=10)
+    parser.add_argument("--scale", type=int, default=10)
+    parser.add_argument("-k", "--select", metavar="PATTERN", help="only run matching benchmarks")
+    parser.add_argument("--json", metavar="FILE", help="write the results to FILE")
+    parser.add_argument("--baseline", metavar="FILE", help="compare against earlier results")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    warnings.simplefilter("ignore")
+    rst_extras.register()
+
+    results = {}
+    for name, timer in benchmarks(args.scale):
+        if args.select and not fnmatch.fnmatch(name, args.select):
+            continue
+        # Warm up once: this fills the code cache, so the format phase doesn't include running the
+        # code formatters, and loads anything imported lazily.
+        timer()
+        results[name] = run(timer, args.repeat)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "environment": cache.environment_version(),
+                    "python": platform.python_version(),
+                    "repeat": args.repeat,
+                    "scale": args.scale,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+            f.write("\n")
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        if saved.get("scale") != args.scale:
+            print(f"warning: the baseline was run with --scale {saved.get('scale')}")
+        if saved.get("environment") != cache.environment_version():
+            print(f"baseline environment: {saved.get('environment')}")
+            print(f"current environment:  {cache.environment_version()}")
+        baseline = saved["results"]
+
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) slower by more than {100 * args.threshold:g}%")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
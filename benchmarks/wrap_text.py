@@ -0,0 +1,74 @@
+"""
+Measure `rstfmt.wrap_text` on the paragraphs of some documents.
+
+Usage: python benchmarks/wrap_text.py [-n REPEAT] [-w WIDTH] [FILE...]
+
+With no files, runs over `tests/lipsum.rst` and `sample.rst`. The inline items passed to `wrap_text`
+while formatting the files are recorded first, so only the wrapping itself is timed.
+"""
+
+import argparse
+import os
+import time
+import warnings
+from typing import Any, List, Optional, Tuple
+
+from rstfmt import rst_extras, rstfmt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def record_calls(texts: List[str], width: int) -> List[Tuple[Optional[int], List[Any]]]:
+    calls = []
+    wrap_text = rstfmt.wrap_text
+
+    def recording_wrap_text(width: Optional[int], items: Any) -> Any:
+        items = list(items)
+        calls.append((width, items))
+        return wrap_text(width, items)
+
+    rstfmt.wrap_text = recording_wrap_text
+    try:
+        for text in texts:
+            rstfmt.format_node(width, rstfmt.parse_string(text))
+    finally:
+        rstfmt.wrap_text = wrap_text
+    return calls
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--repeat", type=int, default=200)
+    parser.add_argument("-w", "--width", type=int, default=72)
+    parser.add_argument("files", nargs="*")
+    args = parser.parse_args()
+
+    warnings.simplefilter("ignore")
+    rst_extras.register()
+
+    files = args.files or [
+        os.path.join(ROOT, "tests", "lipsum.rst"),
+        os.path.join(ROOT, "sample.rst"),
+    ]
+    texts = []
+    for fn in files:
+        with open(fn) as f:
+            texts.append(f.read())
+    calls = record_calls(texts, args.width)
+
+    t0 = time.perf_counter()
+    for _ in range(args.repeat):
+        for width, items in calls:
+            for _ in rstfmt.wrap_text(width, items):
+                pass
+    dt = (time.perf_counter() - t0) / (args.repeat * len(calls))
+
+    words = sum(
+        len(i.split() if isinstance(i, str) else i.text.split()) for _, c in calls for i in c
+    )
+    print(f"{len(calls)} calls, {words} words, {args.repeat} repetitions")
+    print(f"{1e6 * dt:8.2f} us/call")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,66 @@
 import argparse
 import difflib
-import glob
+import functools
 import os
+import re
+import shutil
 import sys
+import tempfile
+from concurrent import futures
 from contextlib import nullcontext
-from typing import Any, ContextManager, TextIO, cast
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Iterator,
+    List,
+    Optional,
+    TextIO,
+    Tuple,
+    cast,
+)
 
-from . import debug, rst_extras, rstfmt
+import docutils
+
+from . import cache, debug, discovery, lsp, profiling, rst_extras, rstfmt
 from ._version import __version__
 
 STDIN = "-"
 
+# The name, original contents, and formatted contents of a misformatted file. The formatted contents
+# are only kept when they're needed for a diff.
+Misformatted = Tuple[str, str, Optional[str]]
+
+
+def do_file(args: argparse.Namespace, fn: str, test_jobs: int = 1) -> Optional[Misformatted]:
+    """
+    Handle a single file, returning information about it if it's misformatted and we're only
+    checking. With --test, `test_jobs` is the number of processes to check its widths in.
+    """
+    with profiling.file_timer(fn) as timer:
+        return _do_file(args, fn, timer, test_jobs)
 
-def do_file(args, fn, misformatted):
+
+def _do_file(
+    args: argparse.Namespace, fn: str, timer: profiling.FileTimer, test_jobs: int = 1
+) -> Optional[Misformatted]:
     cm = cast(ContextManager[TextIO], nullcontext(sys.stdin) if fn == STDIN else open(fn))
-    with cm as f:
+    with timer.phase("read"), cm as f:
         inp = f.read()
-    doc = rstfmt.parse_string(inp)
+
+    key = None
+    if args.cache is not None and not (args.test or args.verbose):
+        key = cache.make_key("file", rstfmt.code_formatter_versions(), str(args.width), inp)
+        if args.cache.get(key) is not None:
+            # This exact input is already known to be correctly formatted.
+            if fn == STDIN and not (args.check or args.diff):
+                sys.stdout.write(inp)
+            return None
+
+    with timer.phase("parse"):
+        doc = rstfmt.get_parse_context().parse(inp)
+    with timer.phase("preproc"):
+        rstfmt.preproc(doc)
 
     if args.verbose:
         print("=" * 60, fn, file=sys.stderr)
@@ -24,24 +68,235 @@ def do_file(args, fn, misformatted):
 
     if args.test:
         try:
-            debug.run_test(doc)
+            debug.run_test(doc, fn, test_jobs, inp)
         except AssertionError as e:
             raise AssertionError(f"Failed consistency test on {fn}!") from e
-        return
+        return None
+
+    name = "Standard input" if fn == STDIN else fn
+
+    if args.check and not (args.diff or args.line_ranges):
+        # Only a yes or no answer is needed, so stop formatting at the first difference.
+        with timer.phase("format"):
+            matched = output_matches(rstfmt.format_lines(args.width, doc), inp)
+        if not matched:
+            return (name, inp, None)
+        if key is not None:
+            args.cache.put(key)
+        return None
+
+    if fn != STDIN and not (args.check or args.diff or args.line_ranges):
+        # Stream the output to the file, rather than building it up in memory first. (The writing
+        # is then counted as part of formatting.)
+        with timer.phase("format"):
+            unchanged = write_if_changed(fn, inp, lambda f: rstfmt.format_to(f, args.width, doc))
+        if key is not None and unchanged:
+            args.cache.put(key)
+        return None
 
-    output = rstfmt.format_node(args.width, doc)
+    with timer.phase("format"):
+        if args.line_ranges:
+            output = rstfmt.format_ranges(args.width, doc, inp, args.line_ranges)
+        else:
+            output = rstfmt.format_node(args.width, doc)
+    # Only a fully formatted file can be remembered as such.
+    if key is not None and output == inp and not args.line_ranges:
+        args.cache.put(key)
 
     if args.check or args.diff:
         if output != inp:
-            misformatted.append(("Standard input" if fn == STDIN else fn, inp, output))
-        return
+            return (name, inp, output)
+        return None
+
+    with timer.phase("write"):
+        if fn == STDIN:
+            # Written in one go, so that an error partway through formatting doesn't leave partial
+            # output behind.
+            sys.stdout.write(output)
+        elif output != inp:
+            write_if_changed(fn, inp, lambda f: f.write(output))
+    return None
+
+
+def output_matches(lines: Iterator[str], expected: str) -> bool:
+    """
+    Return whether the formatted lines, each followed by a newline, make up the expected text,
+    without generating any more of them after the first difference.
+    """
+    pos = 0
+    for line in lines:
+        end = pos + len(line)
+        if not expected.startswith(line, pos) or not expected.startswith("\n", end):
+            return False
+        pos = end + 1
+    return pos == len(expected)
+
+
+class MatchingWriter:
+    """
+    Passes writes through to a stream, keeping track of whether everything written so far matches
+    the expected text.
+    """
+
+    def __init__(self, stream: TextIO, expected: str) -> None:
+        self.stream = stream
+        self.expected = expected
+        self.pos = 0
+        self.matches = True
+
+    def write(self, s: str) -> int:
+        if self.matches:
+            if self.expected.startswith(s, self.pos):
+                self.pos += len(s)
+            else:
+                self.matches = False
+        return self.stream.write(s)
 
-    if fn != STDIN and output == inp:
+    def matched(self) -> bool:
+        return self.matches and self.pos == len(self.expected)
+
+
+def write_if_changed(fn: str, old: str, write: Callable[[TextIO], object]) -> bool:
+    """
+    Replace the contents of the file with whatever `write` writes, unless that's the same as `old`,
+    returning whether it was. The new contents go to a temporary file that's renamed over the
+    original, so the file is never left half-written.
+    """
+    path = os.path.realpath(fn)
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.", suffix=".tmp"
+    )
+    try:
+        with open(fd, "w") as f:
+            writer = MatchingWriter(f, old)
+            write(cast(TextIO, writer))
+        if writer.matched():
+            os.unlink(tmp)
+            return True
+        shutil.copymode(path, tmp)
+        os.replace(tmp, path)
+        return False
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def line_range(s: str) -> Tuple[int, int]:
+    try:
+        start, end = map(int, s.split("-"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid line range {s!r}; expected START-END")
+    if not 1 <= start <= end:
+        raise argparse.ArgumentTypeError(f"invalid line range {s!r}; expected 1 <= START <= END")
+    return start, end
+
+
+def regex(s: str) -> str:
+    try:
+        re.compile(s)
+    except re.error as e:
+        raise argparse.ArgumentTypeError(f"invalid regular expression {s!r}: {e}")
+    return s
+
+
+def iter_files(args: argparse.Namespace) -> Iterator[str]:
+    extensions = [e for exts in args.ext or ["rst"] for e in exts.split(",") if e]
+    excludes = discovery.compile_excludes(args.exclude, args.extend_exclude)
+    if args.changed_since is not None:
+        yield from discovery.changed_files(
+            args.changed_since, args.paths or ["."], extensions, excludes
+        )
         return
+    for path in args.paths or [STDIN]:
+        if os.path.isdir(path):
+            yield from discovery.find_files(path, extensions, excludes)
+        else:
+            yield path
+
+
+def init_worker(args: argparse.Namespace) -> None:
+    rst_extras.register()
+    rstfmt.code_cache.disk = args.cache
+    if args.profile:
+        profiling.instrument()
+
+
+def do_batch(
+    args: argparse.Namespace, files: List[str]
+) -> Tuple[List[Optional[Misformatted]], Optional[profiling.Profile]]:
+    """
+    Handle some files in a worker process, along with their profile if we're profiling. (Each batch
+    gets a separate profile, to be merged by the main process.)
+    """
+    if not args.profile:
+        return [do_remote_file(args, fn) for fn in files], None
+    with profiling.recording() as profile:
+        return [do_remote_file(args, fn) for fn in files], profile
+
 
-    cm = cast(ContextManager[TextIO], nullcontext(sys.stdout) if fn == STDIN else open(fn, "w"))
-    with cm as f:
-        f.write(output)
+def do_remote_file(args: argparse.Namespace, fn: str) -> Optional[Misformatted]:
+    try:
+        return do_file(args, fn)
+    except docutils.utils.SystemMessage as e:
+        raise rstfmt.ParseError(f"{fn}: {e}") from None
+
+
+def collect(
+    args: argparse.Namespace, results: Iterator[Optional[Misformatted]]
+) -> List[Optional[Misformatted]]:
+    collected = []
+    for r in results:
+        collected.append(r)
+        if args.fail_fast and r is not None:
+            break
+    return collected
+
+
+def do_files(args: argparse.Namespace, files: List[str]) -> List[Optional[Misformatted]]:
+    """
+    Handle all the given files, spreading them across worker processes if requested. The results
+    are in the same order as the files regardless of how the work was split up. With --fail-fast,
+    they stop at the first misformatted file.
+    """
+    jobs = args.jobs or os.cpu_count() or 1
+    remote = [fn for fn in files if fn != STDIN]
+    if jobs == 1 or len(remote) <= 1:
+        # With a single file to test, spread its widths across the processes instead.
+        test_jobs = jobs if args.test else 1
+        return collect(args, (do_file(args, fn, test_jobs) for fn in files))
+
+    # Hand out files in batches so the per-file IPC overhead doesn't dominate for small files, while
+    # keeping the batches small enough that the work stays evenly spread. When we might stop early,
+    # keep them smaller still, since batches that have already started have to be waited for.
+    chunksize = max(1, len(remote) // (4 * jobs))
+    if args.fail_fast:
+        chunksize = min(chunksize, 4)
+    batches = [remote[i : i + chunksize] for i in range(0, len(remote), chunksize)]
+
+    with futures.ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(args,)) as pool:
+        pending = [pool.submit(do_batch, args, batch) for batch in batches]
+
+        def remote_results() -> Iterator[Optional[Misformatted]]:
+            profile = profiling.current()
+            for future in pending:
+                results, p = future.result()
+                if profile is not None and p is not None:
+                    profile.merge(p)
+                yield from results
+
+        try:
+            results = remote_results()
+            # Standard input can only be read by this process.
+            return collect(
+                args, (do_file(args, fn) if fn == STDIN else next(results) for fn in files)
+            )
+        finally:
+            # Drop whatever hasn't started yet if we stopped early, or if something failed.
+            for future in pending:
+                future.cancel()
 
 
 def main() -> None:
@@ -57,13 +312,86 @@ def main() -> None:
         action="store_true",
         help="don't update files, but show a diff of what would change",
     )
+    parser.add_argument(
+        "--fail-fast",
+        action="store_true",
+        help="with --check or --diff, stop at the first file that is not formatted",
+    )
     parser.add_argument(
         "-w", "--width", type=int, default=72, help="the target line length in characters"
     )
+    parser.add_argument(
+        "--line-ranges",
+        action="append",
+        type=line_range,
+        default=[],
+        metavar="START-END",
+        help="only format the top-level elements that overlap these lines (one-based, inclusive;"
+        " can be given multiple times)",
+    )
     parser.add_argument(
         "--ext",
-        default="rst",
-        help="the extension of files to look at when passed a directory (default `rst`)",
+        action="append",
+        help="the extension of files to look at when passed a directory (default `rst`; can be"
+        " comma-separated or given multiple times)",
+    )
+    parser.add_argument(
+        "--exclude",
+        type=regex,
+        metavar="REGEX",
+        help="a regular expression for files and directories to skip when walking directories"
+        f" (default `{discovery.DEFAULT_EXCLUDES}`); paths matched by .gitignore files are also"
+        " skipped",
+    )
+    parser.add_argument(
+        "--extend-exclude",
+        type=regex,
+        action="append",
+        default=[],
+        metavar="REGEX",
+        help="like --exclude, but adds to the default rather than replacing it",
+    )
+    parser.add_argument(
+        "--changed-since",
+        metavar="REF",
+        help="only handle the files under the given paths (default the current directory) that"
+        " differ from the given git revision, including untracked ones",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="the number of files to process in parallel (0 means one per CPU; default 1)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="don't read or write the cache of formatted inputs and code blocks",
+    )
+    parser.add_argument(
+        "--stdio",
+        action="store_true",
+        help="run as a language server for editors, speaking LSP on standard input and output",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="report where the time went: per-file phases, node formatters, and code formatters"
+        " (combine with --no-cache to profile all the work)",
+    )
+    parser.add_argument(
+        "--profile-format",
+        choices=["table", "json"],
+        default="table",
+        help="how to print the profile, to standard error (default `table`)",
+    )
+    parser.add_argument(
+        "--profile-top",
+        type=int,
+        default=10,
+        metavar="N",
+        help="the number of slowest files to list in the profile (default 10)",
     )
     parser.add_argument(
         "--test", action="store_true", help="[internal] run tests instead of updating files"
@@ -81,21 +409,41 @@ def main() -> None:
 
     rst_extras.register()
 
-    misformatted = []
+    args.cache = None if args.no_cache else cache.Cache(cache.default_path())
+    rstfmt.code_cache.disk = args.cache
+    try:
+        paths = list(iter_files(args))
+    except discovery.GitError as e:
+        parser.error(f"--changed-since: {e}")
+    if args.line_ranges and len(paths) != 1:
+        parser.error("--line-ranges can only be used with a single file")
 
-    for path in args.paths or [STDIN]:
-        if os.path.isdir(path):
-            for f in glob.iglob(os.path.join(path, "**", "*." + args.ext), recursive=True):
-                do_file(args, f, misformatted)
+    if args.profile:
+        profiling.instrument()
+
+    try:
+        if args.stdio:
+            sys.exit(lsp.serve(args.width))
+        if args.profile:
+            with profiling.recording() as profile:
+                misformatted = [r for r in do_files(args, paths) if r is not None]
+            sys.stderr.write(profile.report(args.profile_format, args.profile_top))
         else:
-            do_file(args, path, misformatted)
+            misformatted = [r for r in do_files(args, paths) if r is not None]
+    finally:
+        if args.cache is not None:
+            args.cache.trim()
+            args.cache.close()
 
     if misformatted:
         for fn, old, new in misformatted:
             if args.diff:
-                old = old.splitlines(keepends=True)
-                new = new.splitlines(keepends=True)
-                sys.stdout.writelines(difflib.unified_diff(old, new, fromfile=fn, tofile=fn))
+                assert new is not None
+                old_lines = old.splitlines(keepends=True)
+                new_lines = new.splitlines(keepends=True)
+                sys.stdout.writelines(
+                    difflib.unified_diff(old_lines, new_lines, fromfile=fn, tofile=fn)
+                )
             else:
                 print(fn, "is not correctly formatted!")
         sys.exit(1)
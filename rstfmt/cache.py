@@ -0,0 +1,191 @@
+"""
+Persistent caching of formatting results across runs and processes.
+
+Entries live in a SQLite database in the user's cache directory, which takes care of concurrent
+readers and writers. Keys are hashes that cover the versions of everything that can affect the
+output, so entries written by other versions are never used; they just age out through the
+size-bounded LRU eviction.
+"""
+
+import hashlib
+import importlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+import warnings
+from typing import Any, Dict, Optional
+
+from ._version import __version__
+
+# The total size of keys and values to keep before evicting the least recently used entries.
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+# When trimming, shrink to this fraction of the maximum so we don't have to trim on every run.
+TRIM_TARGET = 0.8
+# How stale an entry's last-used time has to be before a hit bothers updating it. This keeps hits,
+# which are by far the most common operation, from turning into writes.
+USED_REFRESH_SECONDS = 60 * 60
+
+
+def user_cache_dir() -> str:
+    path = os.environ.get("RSTFMT_CACHE_DIR")
+    if path:
+        return path
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~/AppData/Local")
+    elif sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "rstfmt")
+
+
+def default_path() -> str:
+    return os.path.join(user_cache_dir(), "cache.sqlite3")
+
+
+def package_version(name: str) -> str:
+    try:
+        from importlib import metadata
+
+        return metadata.version(name)
+    except Exception:
+        # Either Python 3.7, which lacks `importlib.metadata`, or the package isn't installed in a
+        # way it knows about.
+        try:
+            return str(getattr(importlib.import_module(name), "__version__", "unknown"))
+        except ImportError:
+            return "missing"
+
+
+_environment: Optional[str] = None
+
+
+def environment_version() -> str:
+    """
+    Return a string identifying the versions of everything that can affect formatting.
+    """
+    global _environment
+    if _environment is None:
+        versions = [f"rstfmt={__version__}"]
+        versions.extend(f"{p}={package_version(p)}" for p in ["black", "docutils", "sphinx"])
+        _environment = " ".join(versions)
+    return _environment
+
+
+def make_key(*parts: str) -> str:
+    h = hashlib.sha256()
+    for p in (environment_version(),) + parts:
+        h.update(p.encode("utf-8", "surrogatepass"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class Cache:
+    """
+    A size-bounded key-value store on disk.
+
+    The database connection is opened on first use and shared by all threads, and instances can be
+    pickled to hand to worker processes, each of which opens its own connection. Any error accessing
+    the database disables the cache with a warning instead of failing the formatting.
+    """
+
+    def __init__(self, path: str, max_size: int = DEFAULT_MAX_SIZE) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.disabled = False
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.RLock()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        del state["_conn"], state["_lock"]
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._conn = None
+        self._lock = threading.RLock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None, check_same_thread=False
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries"
+                " (key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, used REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_used ON entries (used)")
+            self._conn = conn
+        return self._conn
+
+    def _fail(self, e: Exception) -> None:
+        warnings.warn(f"disabling cache at {self.path}: {e}")
+        self.disabled = True
+
+    def get(self, key: str) -> Optional[bytes]:
+        if self.disabled:
+            return None
+        try:
+            with self._lock:
+                conn = self._connect()
+                row = conn.execute(
+                    "SELECT value, used FROM entries WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    return None
+                now = time.time()
+                if row[1] < now - USED_REFRESH_SECONDS:
+                    conn.execute("UPDATE entries SET used = ? WHERE key = ?", (now, key))
+                return bytes(row[0])
+        except (sqlite3.Error, OSError) as e:
+            self._fail(e)
+            return None
+
+    def put(self, key: str, value: bytes = b"") -> None:
+        if self.disabled:
+            return
+        try:
+            with self._lock:
+                self._connect().execute(
+                    "INSERT OR REPLACE INTO entries (key, value, size, used) VALUES (?, ?, ?, ?)",
+                    (key, value, len(key) + len(value), time.time()),
+                )
+        except (sqlite3.Error, OSError) as e:
+            self._fail(e)
+
+    def trim(self) -> None:
+        """
+        Evict the least recently used entries if the cache has grown past its maximum size.
+        """
+        if self.disabled:
+            return
+        try:
+            with self._lock:
+                conn = self._connect()
+                (total,) = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()
+                if total <= self.max_size:
+                    return
+                excess = total - int(TRIM_TARGET * self.max_size)
+                doomed = []
+                for key, size in conn.execute("SELECT key, size FROM entries ORDER BY used"):
+                    if excess <= 0:
+                        break
+                    doomed.append((key,))
+                    excess -= size
+                conn.execute("BEGIN IMMEDIATE")
+                with conn:
+                    conn.executemany("DELETE FROM entries WHERE key = ?", doomed)
+        except (sqlite3.Error, OSError) as e:
+            self._fail(e)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
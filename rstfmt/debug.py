@@ -1,8 +1,19 @@
-from typing import Iterator, TextIO, Tuple
+import io
+import os
+import re
+import tempfile
+from concurrent import futures
+from typing import Iterator, List, Optional, TextIO, Tuple, Union
 
 import docutils
 
-from . import rstfmt
+from . import cache, rst_extras, rstfmt
+
+# The widths to check that formatting is stable at, where None means an unlimited width.
+WIDTHS: List[Optional[int]] = [1, 2, 3, 5, 8, 13, 34, 55, 89, 144, 72, None]
+
+# The width that failed, the dumps of the original and reparsed trees, and the two outputs.
+Failure = Tuple[Optional[int], str, str, str, str]
 
 
 def _dump_lines(node: docutils.nodes.Node) -> Iterator[Tuple[int, str]]:
@@ -23,6 +34,12 @@ def dump_node(node: docutils.nodes.Node, file: TextIO) -> None:
         print("    " * indent + line, file=file)
 
 
+def dump_string(node: docutils.nodes.Node) -> str:
+    f = io.StringIO()
+    dump_node(node, f)
+    return f.getvalue()
+
+
 def iter_descendants(node: docutils.nodes.Node) -> Iterator[docutils.nodes.Node]:
     for c in node.children:
         yield c
@@ -51,19 +68,16 @@ def node_eq(d1: docutils.nodes.Node, d2: docutils.nodes.Node) -> bool:
 
     if isinstance(d1, docutils.nodes.literal_block):
         if "python" in d1["classes"]:
-            import black
-
-            # Check that either the outputs are equal or both calls to Black fail to parse.
-            t1 = t2 = object()
-            try:
-                t1 = black.format_str(text_contents(d1), mode=black.FileMode())
-            except black.InvalidInput:
-                pass
-            try:
-                t2 = black.format_str(text_contents(d2), mode=black.FileMode())
-            except black.InvalidInput:
-                pass
-            return bool(t1 == t2)
+            # Check that either the outputs are equal or both calls to Black fail. (This goes
+            # through the same cache as formatting, so it rarely has to run Black again, and
+            # identical code doesn't need to be run through it at all.)
+            c1 = text_contents(d1)
+            c2 = text_contents(d2)
+            if c1 == c2:
+                return True
+            t1, _ = rstfmt.code_cache.format("python", c1)
+            t2, _ = rstfmt.code_cache.format("python", c2)
+            return t1 == t2
 
     if len(d1.children) != len(d2.children):
         print("different num children")
@@ -75,27 +89,88 @@ def node_eq(d1: docutils.nodes.Node, d2: docutils.nodes.Node) -> bool:
     return all(node_eq(c1, c2) for c1, c2 in zip(d1.children, d2.children))
 
 
-def run_test(doc: docutils.nodes.document) -> None:
+def check_width(doc: docutils.nodes.document, width: Optional[int]) -> Optional[Failure]:
+    """
+    Check that formatting at the given width preserves the document's structure and that the
+    result is already formatted.
+    """
+    output = rstfmt.format_node(width, doc)
+    doc2 = rstfmt.parse_string(output)
+    output2 = rstfmt.format_node(width, doc2)
+    if node_eq(doc, doc2) and output == output2:
+        return None
+    return (width, dump_string(doc), dump_string(doc2), output, output2)
+
+
+def _init_worker(disk: Optional[cache.Cache]) -> None:
+    rst_extras.register()
+    rstfmt.code_cache.disk = disk
+
+
+def _check_source(source: str, width: Optional[int]) -> Optional[Failure]:
+    try:
+        return check_width(rstfmt.parse_string(source), width)
+    except docutils.utils.SystemMessage as e:
+        raise rstfmt.ParseError(f"width {width}: {e}") from None
+
+
+def write_failure(name: str, failure: Failure) -> str:
+    """
+    Write the dumps for a failed test to a new directory, returning its path. Each failure gets its
+    own directory, so concurrent runs don't overwrite each other's.
+    """
+    prefix = re.sub(r"[^\w.-]", "_", os.path.basename(name)) or "doc"
+    path = tempfile.mkdtemp(prefix=f"rstfmt-{prefix}-")
+    _, dump1, dump2, output, output2 = failure
+    for fn, contents in [
+        ("dump1.txt", dump1),
+        ("dump2.txt", dump2),
+        ("out1.txt", output + "\n"),
+        ("out2.txt", output2 + "\n"),
+    ]:
+        with open(os.path.join(path, fn), "w") as f:
+            f.write(contents)
+    return path
+
+
+def run_test(
+    doc: Union[str, docutils.nodes.document],
+    name: str = "<string>",
+    jobs: int = 1,
+    source: Optional[str] = None,
+) -> None:
+    """
+    Check that the document formats consistently at each of `WIDTHS`, raising an AssertionError
+    that names the directory the dumps were written to if not.
+
+    With more than one job and the document's source, the widths are checked in separate processes,
+    each parsing the source again.
+    """
     if isinstance(doc, str):
+        source = doc
         doc = rstfmt.parse_string(doc)
 
-    for width in [1, 2, 3, 5, 8, 13, 34, 55, 89, 144, 72, None]:
-        output = rstfmt.format_node(width, doc)
-        doc2 = rstfmt.parse_string(output)
-        output2 = rstfmt.format_node(width, doc2)
-
-        try:
-            assert node_eq(doc, doc2)
-            assert output == output2
-        except AssertionError:
-            with open("/tmp/dump1.txt", "w") as f:
-                dump_node(doc, f)
-            with open("/tmp/dump2.txt", "w") as f:
-                dump_node(doc2, f)
-
-            with open("/tmp/out1.txt", "w") as f:
-                print(output, file=f)
-            with open("/tmp/out2.txt", "w") as f:
-                print(output2, file=f)
-
-            raise
+    failure = None
+    if jobs > 1 and source is not None:
+        with futures.ProcessPoolExecutor(
+            min(jobs, len(WIDTHS)), initializer=_init_worker, initargs=(rstfmt.code_cache.disk,)
+        ) as pool:
+            pending = [pool.submit(_check_source, source, width) for width in WIDTHS]
+            try:
+                # Report the first failure in the order of the widths, as the serial loop does.
+                for future in pending:
+                    failure = future.result()
+                    if failure is not None:
+                        break
+            finally:
+                for future in pending:
+                    future.cancel()
+    else:
+        for width in WIDTHS:
+            failure = check_width(doc, width)
+            if failure is not None:
+                break
+
+    if failure is not None:
+        path = write_failure(name, failure)
+        raise AssertionError(f"inconsistent formatting at width {failure[0]}; see {path}")
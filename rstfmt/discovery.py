@@ -0,0 +1,162 @@
+"""
+Finding the files to format under the directories given on the command line.
+
+Directories are walked with `os.scandir`, and excluded ones are skipped without being descended
+into. A path is excluded if it matches any of the exclusion regexes or the `.gitignore` files that
+apply to it. As in Black, the regexes are searched for in the path relative to the directory being
+walked, with a leading slash, and with a trailing slash for directories.
+"""
+
+import os
+import re
+import subprocess
+from typing import Any, Iterable, Iterator, List, Optional, Pattern, Sequence, Set, Tuple
+
+# Hidden directories (like `.git`, `.tox`, and `.venv`) are skipped, as they were when files were
+# found by globbing.
+DEFAULT_EXCLUDES = r"/(\.[^/]+|venv|_build|buck-out|build|dist|__pypackages__|node_modules)/"
+
+# The `.gitignore` files that apply under some directory, with the directory each is relative to.
+Ignores = Tuple[Tuple[str, Any], ...]
+
+
+class GitError(Exception):
+    pass
+
+
+def read_gitignore(directory: str) -> Optional[Any]:
+    try:
+        with open(os.path.join(directory, ".gitignore")) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    # Only needed when walking directories, so don't import it up front.
+    import pathspec
+
+    return pathspec.GitIgnoreSpec.from_lines(lines)
+
+
+def ancestor_ignores(root: str) -> Ignores:
+    """
+    Return the `.gitignore` files that apply to the given directory from above it, up to the root of
+    the repository it's in. (The one in the directory itself is picked up by the walk.)
+    """
+    ancestors = []
+    d = os.path.abspath(root)
+    while True:
+        parent = os.path.dirname(d)
+        if os.path.exists(os.path.join(d, ".git")) or parent == d:
+            break
+        d = parent
+        ancestors.append(d)
+    if not os.path.exists(os.path.join(d, ".git")):
+        return ()
+    ignores = []
+    for a in reversed(ancestors):
+        spec = read_gitignore(a)
+        if spec is not None:
+            ignores.append((a, spec))
+    return tuple(ignores)
+
+
+def is_ignored(path: str, is_dir: bool, ignores: Ignores) -> bool:
+    suffix = "/" if is_dir else ""
+    for base, spec in ignores:
+        rel = os.path.relpath(path, base).replace(os.sep, "/")
+        if spec.match_file(rel + suffix):
+            return True
+    return False
+
+
+def is_excluded(rel: str, is_dir: bool, excludes: Sequence[Pattern[str]]) -> bool:
+    path = "/" + rel.replace(os.sep, "/") + ("/" if is_dir else "")
+    return any(e.search(path) for e in excludes)
+
+
+def has_extension(name: str, extensions: Iterable[str]) -> bool:
+    return any(name.endswith("." + ext) for ext in extensions)
+
+
+def find_files(
+    root: str, extensions: Sequence[str], excludes: Sequence[Pattern[str]]
+) -> Iterator[str]:
+    """
+    Generate the files with any of the given extensions under the directory, in sorted order.
+    Symbolic links to directories aren't followed.
+    """
+    stack: List[Tuple[str, Ignores]] = [(root, ancestor_ignores(root))]
+    while stack:
+        directory, ignores = stack.pop()
+        spec = read_gitignore(directory)
+        if spec is not None:
+            ignores += ((directory, spec),)
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            continue
+
+        subdirs = []
+        for entry in entries:
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if is_excluded(os.path.relpath(entry.path, root), is_dir, excludes):
+                continue
+            if ignores and is_ignored(entry.path, is_dir, ignores):
+                continue
+            if is_dir:
+                subdirs.append(entry.path)
+            elif has_extension(entry.name, extensions) and entry.is_file():
+                yield entry.path
+        stack.extend((d, ignores) for d in reversed(subdirs))
+
+
+def git(*args: str) -> str:
+    try:
+        proc = subprocess.run(
+            ["git", *args],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            encoding="utf-8",
+            check=True,
+        )
+    except OSError as e:
+        raise GitError(f"can't run git: {e}")
+    except subprocess.CalledProcessError as e:
+        raise GitError(e.stderr.strip() or f"git {args[0]} failed")
+    return proc.stdout
+
+
+def changed_files(
+    ref: str, roots: Sequence[str], extensions: Sequence[str], excludes: Sequence[Pattern[str]]
+) -> List[str]:
+    """
+    Return the files under the given paths that differ from the given git revision, including ones
+    that aren't tracked yet (but not ignored ones) and excluding deleted ones.
+    """
+    top = git("rev-parse", "--show-toplevel").rstrip("\n")
+    # Run from the top, since `ls-files` only lists files under the directory it's run in.
+    names = git("-C", top, "diff", "--name-only", "-z", "--diff-filter=d", ref, "--").split("\0")
+    names += git(
+        "-C", top, "ls-files", "--others", "--exclude-standard", "--full-name", "-z"
+    ).split("\0")
+
+    abs_roots = [os.path.abspath(r) for r in roots]
+    found: Set[str] = set()
+    for name in names:
+        if not name:
+            continue
+        path = os.path.join(top, name)
+        if not os.path.isfile(path):
+            continue
+        for root in abs_roots:
+            if path == root:
+                found.add(path)
+            elif path.startswith(root.rstrip(os.sep) + os.sep):
+                rel = os.path.relpath(path, root)
+                if has_extension(path, extensions) and not is_excluded(rel, False, excludes):
+                    found.add(path)
+    return sorted(os.path.relpath(p) for p in found)
+
+
+def compile_excludes(exclude: Optional[str], extend_exclude: Sequence[str]) -> List[Pattern[str]]:
+    return [re.compile(p) for p in [exclude or DEFAULT_EXCLUDES, *extend_exclude] if p]
@@ -0,0 +1,317 @@
+"""
+A language server for editors, speaking JSON-RPC over standard input and output.
+
+Only formatting is supported: `textDocument/formatting` and `textDocument/rangeFormatting`, along
+with enough of the document synchronization protocol to know what's in the editor's buffers. Keeping
+one process around for the whole editing session means the imports, parser setup, and code block
+cache are paid for once rather than on every save, without needing to run rstfmtd.
+"""
+
+import difflib
+import json
+import logging
+import sys
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Tuple
+
+import docutils
+
+from . import rstfmt
+
+# Error codes from the JSON-RPC and LSP specifications.
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+SERVER_NOT_INITIALIZED = -32002
+REQUEST_FAILED = -32803
+
+# The `TextDocumentSyncKind` for sending the full text on every change.
+SYNC_FULL = 1
+
+log = logging.getLogger("rstfmt.lsp")
+
+Json = Any
+Position = Dict[str, int]
+
+
+class ResponseError(Exception):
+    def __init__(self, code: int, message: str) -> None:
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+def read_message(f: BinaryIO) -> Optional[Json]:
+    """
+    Read one message, returning None at the end of the input. A body that isn't valid JSON raises a
+    `ResponseError`, after which reading can carry on with the next message; bad headers raise a
+    `ValueError` or `KeyError`, since there's no telling where the next message starts.
+    """
+    headers = {}
+    while True:
+        line = f.readline()
+        if not line:
+            return None
+        line = line.strip()
+        if not line:
+            break
+        name, _, value = line.decode("ascii").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = f.read(int(headers["content-length"]))
+    try:
+        return json.loads(body.decode("utf-8"))
+    except ValueError as e:
+        raise ResponseError(PARSE_ERROR, f"Parse error: {e}")
+
+
+def write_message(f: BinaryIO, message: Json) -> None:
+    body = json.dumps(message).encode("utf-8")
+    f.write(b"Content-Length: %d\r\n\r\n" % len(body) + body)
+    f.flush()
+
+
+def utf16_len(s: str) -> int:
+    # LSP counts characters in UTF-16 code units.
+    return len(s.encode("utf-16-le")) // 2
+
+
+def text_edits(old: str, new: str) -> List[Json]:
+    """
+    Return the edits that turn `old` into `new`, each of which replaces a run of whole lines.
+    """
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+
+    def position(i: int) -> Position:
+        # A final line without a newline has to be ended explicitly; there's no next line to point
+        # to the start of.
+        if i == len(old_lines) and old_lines and not old_lines[-1].endswith("\n"):
+            return {"line": i - 1, "character": utf16_len(old_lines[-1])}
+        return {"line": i, "character": 0}
+
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    edits = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        edits.append(
+            {
+                "range": {"start": position(i1), "end": position(i2)},
+                "newText": "".join(new_lines[j1:j2]),
+            }
+        )
+    return edits
+
+
+def uri_to_path(uri: str) -> str:
+    parsed = urllib.parse.urlparse(uri)
+    if parsed.scheme != "file":
+        raise ResponseError(INVALID_PARAMS, f"Unknown document: {uri}")
+    return urllib.request.url2pathname(urllib.parse.unquote(parsed.path))
+
+
+class Server:
+    """
+    The state of a session with an editor: the open documents and recent formatting results.
+    """
+
+    def __init__(self, width: int, cache_size: int = 32) -> None:
+        self.width = width
+        self.cache_size = cache_size
+        self.documents: Dict[str, str] = {}
+        self.initialized = False
+        self.shutdown_requested = False
+        self.exited = False
+        self._incremental: Dict[str, rstfmt.IncrementalFormatter] = {}
+        self._results: "OrderedDict[Tuple[int, str, Optional[Tuple[int, int]]], str]" = (
+            OrderedDict()
+        )
+        self._methods: Dict[str, Callable[[Json], Json]] = {
+            "initialize": self.initialize,
+            "initialized": lambda params: None,
+            "shutdown": self.shutdown,
+            "exit": self.exit,
+            "textDocument/didOpen": self.did_open,
+            "textDocument/didChange": self.did_change,
+            "textDocument/didClose": self.did_close,
+            "textDocument/formatting": self.formatting,
+            "textDocument/rangeFormatting": self.range_formatting,
+        }
+
+    def handle(self, message: Json) -> Optional[Json]:
+        """
+        Handle a single message, returning the response to send, if any.
+        """
+        if not isinstance(message, dict) or not isinstance(message.get("method"), str):
+            if isinstance(message, dict) and "method" not in message:
+                # A response to a request we never make; ignore it.
+                return None
+            return {
+                "jsonrpc": "2.0",
+                "id": None,
+                "error": {"code": INVALID_REQUEST, "message": "Invalid request"},
+            }
+
+        method = message["method"]
+        is_request = "id" in message
+        func = self._methods.get(method)
+        if func is None and method.startswith("$/") and not is_request:
+            # Protocol-specific notifications, like `$/cancelRequest`, can be ignored.
+            return None
+        try:
+            if not self.initialized and method not in ("initialize", "exit"):
+                raise ResponseError(SERVER_NOT_INITIALIZED, "Server not initialized")
+            if func is None:
+                raise ResponseError(METHOD_NOT_FOUND, f"Unknown method: {method}")
+            params = message.get("params") or {}
+            if not isinstance(params, dict):
+                raise ResponseError(INVALID_PARAMS, f"Invalid params for {method}: not an object")
+            try:
+                result = func(params)
+            except (AttributeError, KeyError, TypeError) as e:
+                raise ResponseError(INVALID_PARAMS, f"Invalid params for {method}: {e!r}")
+        except ResponseError as e:
+            if not is_request:
+                log.warning(f"Error handling {method}: {e.message}")
+                return None
+            return {
+                "jsonrpc": "2.0",
+                "id": message["id"],
+                "error": {"code": e.code, "message": e.message},
+            }
+
+        if not is_request:
+            return None
+        return {"jsonrpc": "2.0", "id": message["id"], "result": result}
+
+    def initialize(self, params: Json) -> Json:
+        options = params.get("initializationOptions") or {}
+        if not isinstance(options, dict):
+            raise ResponseError(INVALID_PARAMS, "initializationOptions must be an object")
+        if isinstance(options.get("width"), int):
+            self.width = options["width"]
+        self.initialized = True
+        return {
+            "capabilities": {
+                "textDocumentSync": {"openClose": True, "change": SYNC_FULL},
+                "documentFormattingProvider": True,
+                "documentRangeFormattingProvider": True,
+            },
+            "serverInfo": {"name": "rstfmt"},
+        }
+
+    def shutdown(self, params: Json) -> Json:
+        self.shutdown_requested = True
+        return None
+
+    def exit(self, params: Json) -> Json:
+        self.exited = True
+        return None
+
+    def did_open(self, params: Json) -> Json:
+        doc = params["textDocument"]
+        self.documents[doc["uri"]] = doc["text"]
+        return None
+
+    def did_change(self, params: Json) -> Json:
+        # With full synchronization, the last change holds the whole new text.
+        changes = params["contentChanges"]
+        if changes:
+            self.documents[params["textDocument"]["uri"]] = changes[-1]["text"]
+        return None
+
+    def did_close(self, params: Json) -> Json:
+        self.documents.pop(params["textDocument"]["uri"], None)
+        self._incremental.pop(params["textDocument"]["uri"], None)
+        return None
+
+    def text(self, uri: str) -> str:
+        text = self.documents.get(uri)
+        if text is None:
+            # Not open in the editor, but it may still be a file we can read.
+            try:
+                with open(uri_to_path(uri)) as f:
+                    text = f.read()
+            except OSError as e:
+                raise ResponseError(INVALID_PARAMS, f"Can't read {uri}: {e}")
+        return text
+
+    def format(self, uri: str, text: str, line_range: Optional[Tuple[int, int]] = None) -> str:
+        key = (self.width, text, line_range)
+        result = self._results.get(key)
+        if result is not None:
+            self._results.move_to_end(key)
+            return result
+
+        try:
+            if line_range is None:
+                # Documents tend to be formatted over and over with small changes in between, so
+                # only redo the parts that changed.
+                inc = self._incremental.get(uri)
+                if inc is None or inc.width != self.width:
+                    inc = self._incremental[uri] = rstfmt.IncrementalFormatter(self.width)
+                result = inc.format(text)
+            else:
+                doc = rstfmt.parse_string(text)
+                result = rstfmt.format_ranges(self.width, doc, text, [line_range])
+        except docutils.utils.SystemMessage as e:
+            raise ResponseError(REQUEST_FAILED, f"Failed to parse input: {e}")
+        except Exception as e:
+            log.exception("Error while formatting")
+            raise ResponseError(REQUEST_FAILED, f"Error while formatting: {e}")
+
+        if self.cache_size > 0:
+            self._results[key] = result
+            if len(self._results) > self.cache_size:
+                self._results.popitem(last=False)
+        return result
+
+    def formatting(self, params: Json) -> Json:
+        uri = params["textDocument"]["uri"]
+        text = self.text(uri)
+        return text_edits(text, self.format(uri, text))
+
+    def range_formatting(self, params: Json) -> Json:
+        uri = params["textDocument"]["uri"]
+        text = self.text(uri)
+        start, end = params["range"]["start"], params["range"]["end"]
+        # Convert to one-based inclusive line numbers. A range ending at the start of a line doesn't
+        # include that line.
+        last = end["line"] + (1 if end["character"] > 0 or end["line"] == start["line"] else 0)
+        return text_edits(
+            text, self.format(uri, text, (start["line"] + 1, max(last, start["line"] + 1)))
+        )
+
+
+def serve(width: int, inp: Optional[BinaryIO] = None, out: Optional[BinaryIO] = None) -> int:
+    """
+    Run the server until the editor tells it to exit, returning the exit status to use.
+    """
+    inp = inp or sys.stdin.buffer
+    out = out or sys.stdout.buffer
+    # Anything else printed to standard output would corrupt the protocol stream.
+    sys.stdout = sys.stderr
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+
+    server = Server(width)
+    while not server.exited:
+        try:
+            message = read_message(inp)
+        except ResponseError as e:
+            # There's no telling what the message's id was.
+            write_message(
+                out, {"jsonrpc": "2.0", "id": None, "error": {"code": e.code, "message": e.message}}
+            )
+            continue
+        except (ValueError, KeyError) as e:
+            log.error(f"Failed to read message: {e}")
+            return 1
+        if message is None:
+            return 1
+        response = server.handle(message)
+        if response is not None:
+            write_message(out, response)
+    return 0 if server.shutdown_requested else 1
@@ -0,0 +1,253 @@
+"""
+Profiling of where formatting time goes, for `rstfmt --profile` and `rstfmtd --profile`.
+
+Each file's wall time is split into phases, and the time spent under each node formatter and each
+code formatter is added up across files. The node formatters are timed by wrapping the registered
+ones with `instrument`, which costs enough that it's only done when profiling. Results are collected
+into the `Profile` made current by `recording`, so worker processes can record each job separately
+and send the results back to be merged.
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from . import rstfmt
+
+PHASES = ("read", "parse", "preproc", "format", "code", "write")
+
+Json = Any
+
+
+class Profile:
+    """
+    Timings collected while formatting some files. If `max_files` is set, only that many of the
+    slowest files are kept, so a long-running server doesn't accumulate every document it sees; the
+    totals still cover all of them.
+    """
+
+    def __init__(self, max_files: int = 0) -> None:
+        self.max_files = max_files
+        self.file_count = 0
+        self.phase_totals = dict.fromkeys(PHASES, 0.0)
+        # The time spent in each phase, for each file.
+        self.files: List[Tuple[str, Dict[str, float]]] = []
+        # For each node formatter: the number of calls, the total time, and the time not spent in
+        # other node formatters.
+        self.formatters: Dict[str, List[float]] = {}
+        # For each code formatter language: the number of runs and the total time.
+        self.code: Dict[str, List[float]] = {}
+        # The time spent in nested node formatters, for each node formatter currently running.
+        self._stack: List[float] = []
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state["_stack"] = []
+        return state
+
+    def add_file(self, name: str, times: Dict[str, float]) -> None:
+        self.file_count += 1
+        for phase, t in times.items():
+            self.phase_totals[phase] += t
+        self.files.append((name, times))
+        if self.max_files and len(self.files) >= 2 * self.max_files:
+            self.files = self.slowest(self.max_files)
+
+    def merge(self, other: "Profile") -> None:
+        for name, times in other.files:
+            self.add_file(name, times)
+        for mine, theirs in [(self.formatters, other.formatters), (self.code, other.code)]:
+            for name, stats in theirs.items():
+                totals = mine.setdefault(name, [0] * len(stats))
+                for i, v in enumerate(stats):
+                    totals[i] += v
+
+    def totals(self) -> Dict[str, float]:
+        return dict(self.phase_totals)
+
+    def slowest(self, n: int) -> List[Tuple[str, Dict[str, float]]]:
+        return sorted(self.files, key=lambda f: sum(f[1].values()), reverse=True)[:n]
+
+    def to_json(self, top: int = 10) -> Json:
+        return {
+            "files": self.file_count,
+            "phases": self.totals(),
+            "slowest": [
+                {"file": fn, "total": sum(times.values()), **times}
+                for fn, times in self.slowest(top)
+            ],
+            "formatters": {
+                name: {"calls": int(calls), "total": total, "self": self_time}
+                for name, (calls, total, self_time) in sorted(self.formatters.items())
+            },
+            "code": {
+                lang: {"runs": int(runs), "total": total}
+                for lang, (runs, total) in sorted(self.code.items())
+            },
+        }
+
+    def render(self, top: int = 10) -> str:
+        lines = []
+        totals = self.totals()
+        overall = sum(totals.values()) or 1.0
+        lines.append(f"{self.file_count} files")
+        lines.append("")
+        lines.append(f"{'phase':10} {'seconds':>10} {'share':>7}")
+        for phase, t in totals.items():
+            lines.append(f"{phase:10} {t:10.4f} {100 * t / overall:6.1f}%")
+
+        lines.append("")
+        lines.append(f"slowest files (ms): {'total':>8} " + " ".join(f"{p:>8}" for p in PHASES))
+        for fn, times in self.slowest(top):
+            cells = " ".join(f"{1000 * times[p]:8.2f}" for p in PHASES)
+            lines.append(f"{'':19} {1000 * sum(times.values()):8.2f} {cells}  {fn}")
+
+        lines.append("")
+        lines.append(f"{'formatter':24} {'calls':>8} {'total s':>10} {'self s':>10}")
+        by_self = sorted(self.formatters.items(), key=lambda kv: kv[1][2], reverse=True)
+        for name, (calls, total, self_time) in by_self:
+            lines.append(f"{name:24} {int(calls):8} {total:10.4f} {self_time:10.4f}")
+
+        if self.code:
+            lines.append("")
+            lines.append(f"{'code language':24} {'runs':>8} {'total s':>10}")
+            for lang, (runs, total) in sorted(self.code.items(), key=lambda kv: -kv[1][1]):
+                lines.append(f"{lang:24} {int(runs):8} {total:10.4f}")
+        return "\n".join(lines) + "\n"
+
+    def report(self, output_format: str = "table", top: int = 10) -> str:
+        if output_format == "json":
+            return json.dumps(self.to_json(top), indent=2) + "\n"
+        return self.render(top)
+
+
+_local = threading.local()
+
+
+def current() -> Optional[Profile]:
+    return getattr(_local, "profile", None)
+
+
+@contextmanager
+def recording(profile: Optional[Profile] = None) -> Iterator[Profile]:
+    """
+    Record into the given profile, or a new one, for the duration of the block.
+    """
+    previous = current()
+    _local.profile = profile = profile if profile is not None else Profile()
+    try:
+        yield profile
+    finally:
+        _local.profile = previous
+
+
+class FileTimer:
+    """
+    Times the phases of handling one file. Code formatting happens during formatting, so its time is
+    taken out of the format phase at the end.
+    """
+
+    def __init__(self, profile: Optional[Profile]) -> None:
+        self.profile = profile
+        self.times = dict.fromkeys(PHASES, 0.0)
+        code_cache = rstfmt.code_cache
+        self._code_time = dict(code_cache.format_time)
+        self._code_runs = dict(code_cache.format_runs)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        if self.profile is None:
+            yield
+            return
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] += time.perf_counter() - t0
+
+    def finish(self, name: str) -> None:
+        if self.profile is None:
+            return
+        code_cache = rstfmt.code_cache
+        for lang, t in code_cache.format_time.items():
+            runs = code_cache.format_runs.get(lang, 0) - self._code_runs.get(lang, 0)
+            if runs:
+                dt = t - self._code_time.get(lang, 0.0)
+                stats = self.profile.code.setdefault(lang, [0, 0.0])
+                stats[0] += runs
+                stats[1] += dt
+                self.times["code"] += dt
+        # External formatters run concurrently, so their total can exceed the wall time.
+        self.times["format"] = max(0.0, self.times["format"] - self.times["code"])
+        self.profile.add_file(name, self.times)
+
+
+@contextmanager
+def file_timer(name: str) -> Iterator[FileTimer]:
+    """
+    Time the phases of handling a file, adding them to the current profile, if there is one.
+    """
+    timer = FileTimer(current())
+    try:
+        yield timer
+    finally:
+        timer.finish(name)
+
+
+def _measure(profile: Profile, stats: List[float], func: Any, *args: Any) -> Any:
+    stack = profile._stack
+    stack.append(0.0)
+    t0 = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        dt = time.perf_counter() - t0
+        nested = stack.pop()
+        stats[1] += dt
+        stats[2] += dt - nested
+        if stack:
+            stack[-1] += dt
+
+
+class _TimedIterator:
+    __slots__ = ("profile", "stats", "it")
+
+    def __init__(self, profile: Profile, stats: List[float], it: Iterator[Any]) -> None:
+        self.profile = profile
+        self.stats = stats
+        self.it = it
+
+    def __iter__(self) -> "_TimedIterator":
+        return self
+
+    def __next__(self) -> Any:
+        # Formatters are mostly generators, so most of their work happens here rather than in the
+        # call.
+        return _measure(self.profile, self.stats, next, self.it)
+
+
+def _timed_formatter(name: str, func: rstfmt.NodeFormatter) -> rstfmt.NodeFormatter:
+    def timed(node: Any, ctx: rstfmt.FormatContext) -> Iterator[Any]:
+        profile = current()
+        if profile is None:
+            return func(node, ctx)
+        stats = profile.formatters.get(name)
+        if stats is None:
+            stats = profile.formatters[name] = [0, 0.0, 0.0]
+        stats[0] += 1
+        it = _measure(profile, stats, lambda: iter(func(node, ctx)))
+        return _TimedIterator(profile, stats, it)
+
+    timed.__wrapped__ = func  # type: ignore
+    return timed
+
+
+def instrument() -> None:
+    """
+    Wrap all the registered node formatters so they record into the current profile.
+    """
+    for cls, func in list(rstfmt.formatters.items()):
+        if not hasattr(func, "__wrapped__"):
+            rstfmt.register_formatter(cls, _timed_formatter(func.__name__, func))
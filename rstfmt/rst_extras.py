@@ -2,29 +2,22 @@
 This module handles adding constructs to the reST parser in a way that makes sense for rstfmt.
 Nonstandard directives and roles are inserted into the tree unparsed (wrapped in custom node classes
 defined here) so we can format them the way they came in without without caring about what they
-would normally expand to.
+would normally expand to. The exception is the body of a directive whose content is itself reST
+(admonitions, tabs, etc.), which is parsed into children of the directive node.
+
+Importing Sphinx takes up a large part of rstfmt's startup time, and most documents don't use
+anything from it, so directives are only set up when their names are first looked up, and Sphinx is
+only imported when a document uses a name that docutils doesn't know about.
 """
 
 import importlib
-from typing import Any, Dict, Iterator, List, Optional, Tuple, Type, TypeVar
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Type, TypeVar
 
 import docutils
-import sphinx.directives.code
-import sphinx.directives.other
-import sphinx.ext.autodoc.directive
 from docutils.parsers.rst import Directive, directives, roles
 
-# Import these only to load their domain subclasses.
-from sphinx.domains import c, cpp, python, std  # noqa: F401
-from sphinx.ext import autodoc
-
-try:
-    import sphinx_tabs.tabs
-
-    HAS_SPHINX_TABS = True
-except ImportError:
-    HAS_SPHINX_TABS = False
-
+from . import rstfmt
 
 T = TypeVar("T")
 
@@ -41,16 +34,17 @@ class ref_role(docutils.nodes.Element):
     pass
 
 
-class ReferenceRole(sphinx.util.docutils.ReferenceRole):
-    def run(self) -> Tuple[List[docutils.nodes.Node], List[docutils.nodes.system_message]]:
-        node = ref_role(
-            self.rawtext,
-            name=self.name,
-            has_explicit_title=self.has_explicit_title,
-            target=self.target,
-            title=self.title,
-        )
-        return [node], []
+class DummyOptionSpec(Dict[str, Callable[[str], str]]):
+    """
+    An option spec that accepts every option and passes its value through unchanged. (This is the
+    same as the one in `sphinx.ext.autodoc`, which we don't want to import just for this.)
+    """
+
+    def __bool__(self) -> bool:
+        return True
+
+    def __getitem__(self, key: str) -> Callable[[str], str]:
+        return lambda x: x
 
 
 role_aliases = {
@@ -63,12 +57,41 @@ role_aliases = {
 }
 
 
+rstfmt.register_formatter(directive, rstfmt.Formatters.directive)
+rstfmt.register_formatter(role, rstfmt.Formatters.role)
+rstfmt.register_formatter(ref_role, rstfmt.Formatters.ref_role)
+
+
 def generic_role(r: str, rawtext: str, text: str, *_: Any, **__: Any) -> Any:
     r = role_aliases.get(r.lower(), r)
     text = docutils.utils.unescape(text, restore_backslashes=True)
     return ([role(rawtext, text=text, role=r)], [])
 
 
+def _run_directive(self: docutils.parsers.rst.Directive) -> List[docutils.nodes.Node]:
+    node = directive(directive=self)
+    node.source, node.line = self.state_machine.get_source_and_line(self.lineno)
+    if not self.raw:
+        # Parse the body now, so it ends up as ordinary children of the directive node rather than
+        # having to be parsed again when formatting. The body is formatted independently of what
+        # surrounds the directive, so it's parsed as if it were a document of its own: against a
+        # separate document node, so its target, substitution, and footnote names don't clash with
+        # ones outside, and (as in Sphinx's `nested_parse_with_titles`) with its own title styles.
+        memo = self.state.memo
+        outer = memo.document
+        reporter = rstfmt.IgnoreMessagesReporter(
+            outer.reporter.source, outer.reporter.report_level, outer.reporter.halt_level
+        )
+        saved = memo.document, memo.reporter, memo.title_styles, memo.section_level
+        memo.document = docutils.nodes.document(outer.settings, reporter, source=outer["source"])
+        memo.reporter, memo.title_styles, memo.section_level = reporter, [], 0
+        try:
+            self.state.nested_parse(self.content, self.content_offset, node, match_titles=True)
+        finally:
+            memo.document, memo.reporter, memo.title_styles, memo.section_level = saved
+    return [node]
+
+
 def _add_directive(
     name: str,
     cls: Type[docutils.parsers.rst.Directive],
@@ -82,11 +105,12 @@ def _add_directive(
     #
     # - Relax the option spec so an incorrect name doesn't stop formatting and every option comes
     #   through unchanged.
-    # - Override the run method to just stick the directive into the tree.
+    # - Override the run method to just stick the directive into the tree, along with its parsed body
+    #   if it's not raw.
     # - Add a `raw` attribute to inform formatting later on.
     namespace = {
-        "option_spec": autodoc.directive.DummyOptionSpec(),
-        "run": lambda self: [directive(directive=self)],
+        "option_spec": DummyOptionSpec(),
+        "run": _run_directive,
         "raw": raw,
         **(attrs or {}),
     }
@@ -99,17 +123,69 @@ def _subclasses(cls: Type[T]) -> Iterator[Type[T]]:
         yield from _subclasses(c)
 
 
-def register() -> None:
-    for r in [
-        # Standard roles (https://docutils.sourceforge.io/docs/ref/rst/roles.html) that don't have
-        # equivalent non-role-based markup.
-        "math",
-        "pep-reference",
-        "rfc-reference",
-        "subscript",
-        "superscript",
-    ]:
-        roles.register_canonical_role(r, generic_role)
+non_raw_directives = {
+    "admonition",
+    "attention",
+    "caution",
+    "danger",
+    "error",
+    "hint",
+    "important",
+    "note",
+    "tip",
+    "warning",
+    # `list-table` directives are parsed into table nodes by default and could be formatted as such,
+    # but that's vulnerable to producing malformed tables when the given column widths are too
+    # small, so keep them as directives.
+    "list-table",
+    "tabs",
+    "tab",
+    "group-tab",
+    "code-tab",
+}
+
+
+def _add_docutils_directive(name: str) -> None:
+    module_name, cls_name = directives._directive_registry[name]
+    module = importlib.import_module(f"docutils.parsers.rst.directives.{module_name}")
+    _add_directive(name, getattr(module, cls_name), raw=name not in non_raw_directives)
+
+
+_sphinx_registered = False
+_sphinx_lock = threading.RLock()
+
+
+def _register_sphinx() -> None:
+    global _sphinx_registered
+    # Other threads wait until registration has finished, rather than going on without it, while
+    # this thread can get back here from the imports and return straight away.
+    with _sphinx_lock:
+        if _sphinx_registered:
+            return
+        _sphinx_registered = True
+        _load_sphinx()
+
+
+def _load_sphinx() -> None:
+    import sphinx.directives.code
+    import sphinx.directives.other
+    import sphinx.ext.autodoc.directive
+    import sphinx.util.docutils
+
+    # Import these only to load their domain subclasses.
+    from sphinx.domains import c, cpp, python, std  # noqa: F401
+    from sphinx.ext import autodoc
+
+    class ReferenceRole(sphinx.util.docutils.ReferenceRole):
+        def run(self) -> Tuple[List[docutils.nodes.Node], List[docutils.nodes.system_message]]:
+            node = ref_role(
+                self.rawtext,
+                name=self.name,
+                has_explicit_title=self.has_explicit_title,
+                target=self.target,
+                title=self.title,
+            )
+            return [node], []
 
     roles.register_canonical_role("download", ReferenceRole())
     for domain in _subclasses(sphinx.domains.Domain):
@@ -121,52 +197,21 @@ def register() -> None:
         for name, directive_cls in domain.directives.items():
             _add_directive(f"{domain.name}:{name}", directive_cls)
 
-    # Take the `py` domain as the implicit default. (TODO: Handle files that change the default.)
+    # Take the `py` domain as the implicit default. (TODO: Handle files that change the default.) The
+    # standard docutils directives take precedence over it (for `class`).
     for name, directive_cls in python.PythonDomain.directives.items():
-        _add_directive(name, directive_cls)
-
-    non_raw_directives = {
-        "admonition",
-        "attention",
-        "caution",
-        "danger",
-        "error",
-        "hint",
-        "important",
-        "note",
-        "tip",
-        "warning",
-        # `list-table` directives are parsed into table nodes by default and could be formatted as
-        # such, but that's vulnerable to producing malformed tables when the given column widths are
-        # too small, so keep them as directives.
-        "list-table",
-        "tabs",
-        "tab",
-        "group-tab",
-        "code-tab",
-    }
-
-    # The role directive is defined in a rather odd way under the hood: although it appears to take
-    # one argument and allow options, the class actually specifies that it takes no arguments or
-    # options but does have content; it then does its own parsing of arguments and options based on
-    # the content. I'm not entirely sure why, but I think it's to handle the case of using some
-    # exotic base role that has a body or something. I think just taking an argument is pretty much
-    # good enough, though.
-    _add_directive("role", Directive, attrs={"required_arguments": 1})
-    exclude_directives = {"role"}
-
-    for directive_name, (module, cls_name) in directives._directive_registry.items():
-        if directive_name in exclude_directives:
-            continue
-        module = importlib.import_module(f"docutils.parsers.rst.directives.{module}")
-        cls = getattr(module, cls_name)
-        _add_directive(directive_name, cls, raw=directive_name not in non_raw_directives)
+        if name not in directives._directive_registry:
+            _add_directive(name, directive_cls)
 
     _add_directive("glossary", std.Glossary, raw=False)
     _add_directive("literalinclude", sphinx.directives.code.LiteralInclude)
     _add_directive("toctree", sphinx.directives.other.TocTree)
 
-    if HAS_SPHINX_TABS:
+    try:
+        import sphinx_tabs.tabs
+    except ImportError:
+        pass
+    else:
         _add_directive("tabs", sphinx_tabs.tabs.TabsDirective, raw=False)
         _add_directive("tab", sphinx_tabs.tabs.TabDirective, raw=False)
         _add_directive("group-tab", sphinx_tabs.tabs.GroupTabDirective, raw=False)
@@ -182,3 +227,77 @@ def register() -> None:
         pass
     else:
         _add_directive("argparse", sphinxarg.ext.ArgParseDirective)
+
+
+def _canonical_name(name: str, aliases: Any) -> str:
+    # Language modules map localized names and aliases (like "code-block") to canonical names.
+    try:
+        return str(aliases[name])
+    except (KeyError, TypeError):
+        return name
+
+
+_docutils_directive = directives.directive
+_docutils_role = roles.role
+
+
+def _lookup_directive(name: str, language_module: Any, document: Any) -> Any:
+    normname = name.lower()
+    if normname not in directives._directives:
+        if normname in directives._directive_registry:
+            _add_docutils_directive(normname)
+        elif (
+            _canonical_name(normname, getattr(language_module, "directives", None))
+            not in directives._directive_registry
+        ):
+            _register_sphinx()
+        # Otherwise, it's an alias that docutils resolves to its own directive class.
+    return _docutils_directive(name, language_module, document)
+
+
+def _lookup_role(name: str, language_module: Any, lineno: int, reporter: Any) -> Any:
+    normname = name.lower()
+    if name and normname not in roles._roles:
+        if (
+            _canonical_name(normname, getattr(language_module, "roles", None))
+            not in roles._role_registry
+        ):
+            _register_sphinx()
+    return _docutils_role(name, language_module, lineno, reporter)
+
+
+def register() -> None:
+    for r in [
+        # Standard roles (https://docutils.sourceforge.io/docs/ref/rst/roles.html) that don't have
+        # equivalent non-role-based markup.
+        "math",
+        "pep-reference",
+        "rfc-reference",
+        "subscript",
+        "superscript",
+    ]:
+        roles.register_canonical_role(r, generic_role)
+
+    # The role directive is defined in a rather odd way under the hood: although it appears to take
+    # one argument and allow options, the class actually specifies that it takes no arguments or
+    # options but does have content; it then does its own parsing of arguments and options based on
+    # the content. I'm not entirely sure why, but I think it's to handle the case of using some
+    # exotic base role that has a body or something. I think just taking an argument is pretty much
+    # good enough, though.
+    _add_directive("role", Directive, attrs={"required_arguments": 1})
+
+    # Everything else is registered on demand. Sphinx does the same kind of patching to resolve
+    # names through its domains.
+    directives.directive = _lookup_directive
+    roles.role = _lookup_role
+
+
+def register_all() -> None:
+    """
+    Register every directive and role up front, rather than as they're looked up.
+    """
+    register()
+    _register_sphinx()
+    for name in directives._directive_registry:
+        if name not in directives._directives:
+            _add_docutils_directive(name)
@@ -1,25 +1,37 @@
+import bisect
+import copy
 import itertools
+import os
 import re
+import shutil
 import string
 import subprocess
+import threading
+import time
 import warnings
-from collections import namedtuple
+from collections import OrderedDict
+from concurrent import futures
 from typing import (
     Any,
     Callable,
+    Dict,
     Iterable,
     Iterator,
     List,
     NamedTuple,
     Optional,
+    TextIO,
     Tuple,
     TypeVar,
     Union,
 )
 
-import black
 import docutils
 import docutils.parsers.rst
+import docutils.parsers.rst.states
+import docutils.statemachine
+
+from . import cache
 
 T = TypeVar("T")
 
@@ -126,81 +138,70 @@ inline_iterator = Iterator[inline_item]
 line_iterator = Iterator[str]
 
 
-word_info = namedtuple(
-    "word_info",
-    ["text", "in_markup", "start_space", "end_space", "start_punct", "end_punct"],
-)
-
-
-def split_words(item: inline_item) -> List[word_info]:
-    if isinstance(item, str):
-        if not item:
-            # An empty string is treated as having trailing punctuation: it only
-            # shows up when two inline markup blocks are separated by
-            # backslash-space, and this means that after it is merged with its
-            # predecessor the resulting word will not cause a second escape to
-            # be introduced when merging with the successor.
-            new_words = [word_info(item, False, False, False, False, True)]
-        else:
-            new_words = [word_info(s, False, False, False, False, False) for s in item.split()]
-            if item:
-                if not new_words:
-                    new_words = [word_info("", False, True, True, True, True)]
-                if item[0] in space_chars:
-                    new_words[0] = new_words[0]._replace(start_space=True)
-                if item[-1] in space_chars:
-                    new_words[-1] = new_words[-1]._replace(end_space=True)
-                if item[0] in post_markup_break_chars:
-                    new_words[0] = new_words[0]._replace(start_punct=True)
-                if item[-1] in pre_markup_break_chars:
-                    new_words[-1] = new_words[-1]._replace(end_punct=True)
-    elif isinstance(item, inline_markup):
-        new_words = [word_info(s, True, False, False, False, False) for s in item.text.split()]
-    return new_words
-
-
 def wrap_text(width: Optional[int], items: Iterable[inline_item]) -> Iterator[str]:
     if width is not None and width <= 0:
         raise ValueError(f"Invalid width {width}")
 
-    items = list(items)
-    raw_words = list(chain(map(split_words, items)))
-
-    words = [word_info("", False, True, True, True, True)]
-    for word in raw_words:
-        last = words[-1]
-        if not last.in_markup and word.in_markup and not last.end_space:
-            join = "" if last.end_punct else r"\ "
-            words[-1] = word_info(last.text + join + word.text, True, False, False, False, False)
-        elif last.in_markup and not word.in_markup and not word.start_space:
-            join = "" if word.start_punct else r"\ "
-            words[-1] = word_info(
-                last.text + join + word.text,
-                False,
-                False,
-                word.end_space,
-                word.start_punct,
-                word.end_punct,
-            )
+    # First, split the items into words, gluing inline markup onto any text directly adjacent to it
+    # (with a backslash-escaped space where that's needed for the markup to be recognized). Only the
+    # last word can be glued onto, so we just track a few properties of it: whether it's from inline
+    # markup, and whether it ended with a space or with punctuation that can come right before
+    # markup.
+    #
+    # An empty string is treated as having trailing punctuation: it only shows up when two inline
+    # markup blocks are separated by backslash-space, and this means that after it is merged with its
+    # predecessor the resulting word will not cause a second escape to be introduced when merging
+    # with the successor. A string of only whitespace is an empty word with spaces and punctuation
+    # on both sides.
+    words = [""]
+    in_markup = False
+    end_space = end_punct = True
+    for item in items:
+        if isinstance(item, str):
+            parts = item.split()
+            if parts:
+                start_space = item[0] in space_chars
+                start_punct = item[0] in post_markup_break_chars
+                end_space = item[-1] in space_chars
+                end_punct = item[-1] in pre_markup_break_chars
+            else:
+                parts = [""]
+                start_space = start_punct = end_space = bool(item)
+                end_punct = True
+            if in_markup and not start_space:
+                words[-1] += ("" if start_punct else r"\ ") + parts[0]
+                words.extend(parts[1:])
+            else:
+                words.extend(parts)
+            in_markup = False
         else:
-            words.append(word)
-
-    word_strs = (word.text for word in words if word.text)
+            parts = item.text.split()
+            if not parts:
+                continue
+            if not in_markup and not end_space:
+                words[-1] += ("" if end_punct else r"\ ") + parts[0]
+                words.extend(parts[1:])
+            else:
+                words.extend(parts)
+            in_markup = True
+            end_space = end_punct = False
 
     if width is None:
-        yield " ".join(word_strs)
+        yield " ".join(filter(None, words))
         return
 
+    # Then fill lines greedily.
     buf: List[str] = []
-    n = 0
-    for w in word_strs:
-        n2 = n + bool(buf) + len(w)
-        if buf and n2 > width:
+    n = -1
+    for w in words:
+        if not w:
+            continue
+        n += 1 + len(w)
+        if n > width and buf:
             yield " ".join(buf)
             buf = []
-            n2 = len(w)
+            n = len(w)
         buf.append(w)
-        n = n2
     if buf:
         yield " ".join(buf)
 
@@ -218,35 +219,52 @@ def with_spaces(n: int, lines: Iterable[str]) -> Iterator[str]:
 def preproc(node: docutils.nodes.Node) -> None:
     """
     Do some node preprocessing that is generic across node types and is therefore most convenient to
-    do as a simple recursive function rather than as part of the big dispatcher class.
-    """
-    # Strip all system_message nodes. (Just formatting them with no markup isn't enough, since that
-    # could lead to extra spaces or empty lines between other elements.)
-    node.children = [c for c in node.children if not isinstance(c, docutils.nodes.system_message)]
-
-    # Match references to targets, which helps later with distinguishing whether they're anonymous.
-    for a, b in pairwise(node.children):
-        if isinstance(a, docutils.nodes.reference) and isinstance(b, docutils.nodes.target):
-            a.attributes["target"] = b  # type: ignore
-
-    # Sort contiguous blocks of targets by name.
-    start = None
-    for i, c in enumerate(itertools.chain(node.children, [None])):
-        in_run = start is not None
-        is_target = isinstance(c, docutils.nodes.target)
-        if in_run and not is_target:
-            # Anonymous targets have a value of `[]` for "names", which will sort to the top. Also,
-            # it's important here that `sorted` is stable, or anonymous targets could break.
-            node.children[start:i] = sorted(
-                node.children[start:i], key=lambda t: t.attributes["names"]
-            )
-            start = None
-        elif not in_run and is_target:
-            start = i
+    do as a simple tree walk rather than as part of the big dispatcher class.
 
-    # Recurse.
-    for c in node.children:
-        preproc(c)
+    This walks the tree iteratively, so deeply nested documents can't hit the recursion limit, and
+    makes one pass over the children of each node, only rebuilding the list if there's something to
+    remove.
+    """
+    system_message = docutils.nodes.system_message
+    reference = docutils.nodes.reference
+    target = docutils.nodes.target
+
+    def target_names(t: docutils.nodes.Node) -> Any:
+        return t.attributes["names"]
+
+    stack = [node]
+    while stack:
+        children = stack.pop().children
+        if not children:
+            continue
+
+        # Strip all system_message nodes. (Just formatting them with no markup isn't enough, since
+        # that could lead to extra spaces or empty lines between other elements.)
+        if any(isinstance(c, system_message) for c in children):
+            children[:] = [c for c in children if not isinstance(c, system_message)]
+
+        prev = None
+        start = None
+        for i, c in enumerate(children):
+            if isinstance(c, target):
+                # Match references to targets, which helps later with distinguishing whether they're
+                # anonymous.
+                if isinstance(prev, reference):
+                    prev.attributes["target"] = c  # type: ignore
+                if start is None:
+                    start = i
+            elif start is not None:
+                # Sort contiguous blocks of targets by name. Anonymous targets have a value of `[]`
+                # for "names", which will sort to the top. Also, it's important here that `sorted`
+                # is stable, or anonymous targets could break.
+                if i - start > 1:
+                    children[start:i] = sorted(children[start:i], key=target_names)
+                start = None
+            prev = c
+        if start is not None and len(children) - start > 1:
+            children[start:] = sorted(children[start:], key=target_names)
+
+        stack.extend(children)
 
 
 # Simple reference names can consist of "alphanumerics plus isolated (no two adjacent) internal
@@ -272,28 +290,49 @@ class IgnoreMessagesReporter(docutils.utils.Reporter):
         "Title underline too short.",
     }
 
+    # Set by the base class; declared here since the copy below reads and writes them.
+    halt_level: int
+    max_level: int
+
     def system_message(
         self, level: int, message: str, *children: Any, **kwargs: Any
     ) -> docutils.nodes.system_message:
-        orig_level = self.halt_level  # type: ignore
-        if message in self.ignored_messages:
-            self.halt_level = docutils.utils.Reporter.SEVERE_LEVEL + 1
-        msg = super().system_message(level, message, *children, **kwargs)
-        self.halt_level = orig_level
+        if message not in self.ignored_messages:
+            return super().system_message(level, message, *children, **kwargs)
+        # Report it through a copy that never halts, rather than changing the halt level here while
+        # the message is handled. (The copy shares the observers, so they're still notified.)
+        quiet = copy.copy(self)
+        quiet.halt_level = docutils.utils.Reporter.SEVERE_LEVEL + 1
+        msg = docutils.utils.Reporter.system_message(quiet, level, message, *children, **kwargs)
+        self.max_level = max(self.max_level, quiet.max_level)
         return msg
 
 
 # Main stuff.
 
 
+class CodeFormatError(Exception):
+    pass
+
+
+# Docutils' `SystemMessage` can't be unpickled, so a parse error in a worker process would break the
+# process pool instead of being reported; workers raise this instead.
+class ParseError(Exception):
+    pass
+
+
 class CodeFormatters:
+    # Each of these raises `CodeFormatError` if the code can't be formatted; `format_code` takes care
+    # of reporting that and falling back to the original code.
     @staticmethod
     def python(code: str) -> str:
+        # Importing Black is slow, so only do it once there's actually some Python to format.
+        import black
+
         try:
-            code = black.format_str(code, mode=black.FileMode()).rstrip()
+            return str(black.format_str(code, mode=black.FileMode()).rstrip())
         except Exception as e:
-            warnings.warn(str(e))
-        return code
+            raise CodeFormatError(str(e))
 
     @staticmethod
     def go(code: str) -> str:
@@ -302,9 +341,9 @@ class CodeFormatters:
                 ["gofmt"], input=code, stdout=subprocess.PIPE, encoding="utf-8", check=True
             ).stdout
         except OSError as e:
-            warnings.warn(str(e))
+            raise CodeFormatError(str(e))
         except subprocess.CalledProcessError as e:
-            warnings.warn(f"gofmt failed: {e.stderr}")
+            raise CodeFormatError(f"gofmt failed: {e.stderr}")
         # gofmt uses tabs; including them in the source will cause docutils to expand them out to
         # tab stops, causing odd spacing in the rendering. Instead, we explicitly convert them into
         # four spaces each, which matches common practice on the Go website. (There are also
@@ -320,12 +359,170 @@ class CodeFormatters:
                 ["rustfmt"], input=code, stdout=subprocess.PIPE, encoding="utf-8", check=True
             ).stdout
         except OSError as e:
-            warnings.warn(str(e))
+            raise CodeFormatError(str(e))
         except subprocess.CalledProcessError as e:
-            warnings.warn(f"rustfmt failed: {e.stderr}")
+            raise CodeFormatError(f"rustfmt failed: {e.stderr}")
         return code.rstrip("\n")
 
 
+# The programs run by the external code formatters, used to tell when their versions change.
+code_formatter_programs = {"go": "gofmt", "rust": "rustfmt"}
+
+
+def code_formatter_version(lang: str) -> str:
+    if lang == "python":
+        return f"black {cache.package_version('black')}"
+    program = code_formatter_programs.get(lang)
+    if program is None:
+        return ""
+    # Asking the programs themselves would cost a process launch, which is what we're trying to
+    # avoid, so identify them by where they are and when they were last changed instead.
+    path = shutil.which(program)
+    if path is None:
+        return "missing"
+    return f"{path} {os.stat(path).st_mtime_ns}"
+
+
+class CodeCache:
+    """
+    Memoizes the results of code formatters, keyed by language, formatter version and code.
+
+    Results, including failures, are kept in an in-memory LRU. Successful results are also written
+    to `disk`, if set, so they can be shared between processes and runs.
+    """
+
+    def __init__(self, maxsize: int = 4096, disk: Optional[cache.Cache] = None) -> None:
+        self.maxsize = maxsize
+        self.disk = disk
+        self._memory: "OrderedDict[Tuple[str, str, str], Tuple[Optional[str], Optional[str]]]" = (
+            OrderedDict()
+        )
+        self._versions: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        # Running totals, for instrumentation.
+        self.hits = 0
+        self.misses = 0
+        self.format_time: Dict[str, float] = {}
+        self.format_runs: Dict[str, int] = {}
+
+    def version(self, lang: str) -> str:
+        version = self._versions.get(lang)
+        if version is None:
+            version = self._versions[lang] = code_formatter_version(lang)
+        return version
+
+    def format(self, lang: str, code: str) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Return the formatted code, or None and an error message if the formatter failed.
+        """
+        version = self.version(lang)
+        key = (lang, version, code)
+        with self._lock:
+            result = self._memory.get(key)
+            if result is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return result
+
+        disk_key = None
+        if self.disk is not None:
+            disk_key = cache.make_key("code", lang, version, code)
+            value = self.disk.get(disk_key)
+            if value is not None:
+                result = (value.decode("utf-8", "surrogatepass"), None)
+
+        hit = result is not None
+        if result is None:
+            t0 = time.perf_counter()
+            try:
+                result = (getattr(CodeFormatters, lang)(code), None)
+            except CodeFormatError as e:
+                result = (None, str(e))
+            dt = time.perf_counter() - t0
+            if disk_key is not None and result[0] is not None:
+                self.disk.put(disk_key, result[0].encode("utf-8", "surrogatepass"))  # type: ignore
+
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self.format_time[lang] = self.format_time.get(lang, 0) + dt
+                self.format_runs[lang] = self.format_runs.get(lang, 0) + 1
+            self._memory[key] = result
+            if len(self._memory) > self.maxsize:
+                self._memory.popitem(last=False)
+        return result
+
+
+code_cache = CodeCache()
+
+
+def code_formatter_versions() -> str:
+    """
+    Identify all the code formatters, for caching results that may depend on any of them.
+    """
+    langs = ["python", *sorted(code_formatter_programs)]
+    return " ".join(f"{lang}={code_cache.version(lang)}" for lang in langs)
+
+
+def has_code_formatter(lang: Optional[str]) -> bool:
+    return lang is not None and callable(getattr(CodeFormatters, lang, None))
+
+
+def format_code(lang: Optional[str], code: str) -> str:
+    if not has_code_formatter(lang):
+        return code
+    text, error = code_cache.format(lang, code)  # type: ignore
+    if text is None:
+        warnings.warn(str(error))
+        return code
+    return text
+
+
+def code_block_language(node: docutils.nodes.literal_block) -> Optional[str]:
+    langs = [c for c in node.attributes["classes"] if c != "code"]
+    return langs[0] if langs else None
+
+
+# Languages whose formatters run in a separate process, so that formatting several blocks at once
+# from different threads actually runs them concurrently.
+external_code_languages = {"go", "rust"}
+max_code_formatter_threads = 8
+
+
+def format_external_code(node: docutils.nodes.Node) -> None:
+    """
+    Run the external code formatters for all the literal blocks under the given node concurrently,
+    storing the results on the blocks for `Formatters.literal_block` to pick up.
+
+    Starting a formatter process takes long enough that doing it once per block, one after another,
+    dominates the formatting time of documents with many code snippets.
+    """
+    pending: Dict[Tuple[str, str], List[docutils.nodes.literal_block]] = {}
+    stack = [node]
+    while stack:
+        n = stack.pop()
+        if isinstance(n, docutils.nodes.literal_block):
+            lang = code_block_language(n)
+            if lang in external_code_languages and "formatted_code" not in n.attributes:
+                pending.setdefault((lang, n.astext()), []).append(n)
+        else:
+            stack.extend(n.children)
+
+    if not pending:
+        return
+
+    def run(key: Tuple[str, str]) -> str:
+        return format_code(*key)
+
+    keys = list(pending)
+    with futures.ThreadPoolExecutor(min(len(keys), max_code_formatter_threads)) as pool:
+        for key, text in zip(keys, pool.map(run, keys)):
+            for n in pending[key]:
+                n.attributes["formatted_code"] = text
+
+
 class Formatters:
     # Basic formatting.
     @staticmethod
@@ -360,11 +557,18 @@ class Formatters:
     @staticmethod
     def _list(node: docutils.nodes.Node, ctx: FormatContext) -> line_iterator:
         ctx2 = ctx.with_bullet(ctx.bullet2)
-        subs = [list(fmt(c, ctx2 if i else ctx)) for (i, c) in enumerate(node.children)]
-        if any(len(s) > 2 for s in subs):
-            yield from chain_intersperse("", subs)
-        else:
-            yield from chain(subs)
+        items = (fmt(c, ctx2 if i else ctx) for (i, c) in enumerate(node.children))
+        # Items are separated by blank lines if any of them is longer than two lines. Only the items
+        # before the first long one have to be held back to find that out, and they're all short.
+        held: List[List[str]] = []
+        for item in items:
+            start = list(itertools.islice(item, 3))
+            if len(start) > 2:
+                rest = itertools.chain([itertools.chain(start, item)], items)
+                yield from chain_intersperse("", itertools.chain(held, rest))
+                return
+            held.append(start)
+        yield from chain(held)
 
     @staticmethod
     def bullet_list(node: docutils.nodes.bullet_list, ctx: FormatContext) -> line_iterator:
@@ -473,11 +677,9 @@ class Formatters:
 
         if d.raw:
             yield from prepend_if_any("", with_spaces(3, d.content))
-        else:
-            sub_doc = parse_string("\n".join(d.content))
-            if sub_doc.children:
-                yield ""
-                yield from with_spaces(3, fmt(sub_doc, ctx.indent(3)))
+        elif node.children:
+            yield ""
+            yield from with_spaces(3, chain_intersperse("", fmt_children(node, ctx.indent(3))))
 
     @staticmethod
     def section(node: docutils.nodes.section, ctx: FormatContext) -> line_iterator:
@@ -666,8 +868,12 @@ class Formatters:
 
     @staticmethod
     def target(node: docutils.nodes.target, ctx: FormatContext) -> line_iterator:
-        if not isinstance(node.parent, (docutils.nodes.document, docutils.nodes.section)):
-            return
+        # Targets that aren't at the block level come from inline markup and are formatted along with
+        # it. The bodies of non-raw directives count as block level.
+        parent = node.parent
+        if not isinstance(parent, (docutils.nodes.document, docutils.nodes.section)):
+            if parent.tagname != "directive":
+                return
         if "refuri" in node.attributes:
             body = " " + node.attributes["refuri"]
         elif "refname" in node.attributes:
@@ -690,18 +896,15 @@ class Formatters:
 
     @staticmethod
     def literal_block(node: docutils.nodes.literal_block, ctx: FormatContext) -> line_iterator:
-        langs = [c for c in node.attributes["classes"] if c != "code"]
-        lang = langs[0] if langs else None
+        lang = code_block_language(node)
         yield ".. code::" + (" " + lang if lang else "")
         yield ""
         text = "".join(chain(fmt_children(node, ctx)))
 
-        try:
-            func = getattr(CodeFormatters, lang)
-        except (AttributeError, TypeError):
-            pass
+        if "formatted_code" in node.attributes:
+            text = node.attributes["formatted_code"]
         else:
-            text = func(text)
+            text = format_code(lang, text)
 
         yield from with_spaces(3, text.split("\n"))
 
@@ -728,34 +931,544 @@ class Formatters:
         yield from lines
 
 
+NodeFormatter = Callable[[Any, FormatContext], Iterator[Any]]
+
+# The registered formatters, by node class.
+formatters: Dict[type, NodeFormatter] = {}
+# The formatter to use for each node class that has been seen, which may have been inherited.
+_dispatch: Dict[type, NodeFormatter] = {}
+
+
+def register_formatter(
+    cls: type, func: Optional[NodeFormatter] = None
+) -> Callable[[NodeFormatter], NodeFormatter]:
+    """
+    Register a function to format nodes of the given class, and of its subclasses that don't have
+    formatters of their own. The function takes the node and a `FormatContext` and yields lines of
+    output (or, for inline nodes, strings and `inline_markup` objects to be wrapped by the parent).
+
+    Can also be used as a decorator, as in `@register_formatter(my_node)`.
+    """
+
+    def register(func: NodeFormatter) -> NodeFormatter:
+        formatters[cls] = func
+        _dispatch.clear()
+        return func
+
+    if func is not None:
+        register(func)
+    return register
+
+
+def formatter_for(cls: type) -> NodeFormatter:
+    try:
+        return _dispatch[cls]
+    except KeyError:
+        pass
+    for c in cls.__mro__:
+        func = formatters.get(c)
+        if func is not None:
+            _dispatch[cls] = func
+            return func
+    raise ValueError(f"Unknown node type {cls.__name__}!")
+
+
 def fmt(node: docutils.nodes.Node, ctx: FormatContext) -> Iterator[str]:
     try:
-        func = getattr(Formatters, type(node).__name__)
-    except AttributeError:
-        raise ValueError(f"Unknown node type {type(node).__name__}!")
-    return func(node, ctx)  # type: ignore
+        func = _dispatch[type(node)]
+    except KeyError:
+        func = formatter_for(type(node))
+    return func(node, ctx)
 
 
-def format_node(width: Optional[int], node: docutils.nodes.Node) -> str:
+# The methods of `Formatters` are named after the Docutils node classes they handle.
+for _name in vars(Formatters):
+    _cls = getattr(docutils.nodes, _name, None)
+    if isinstance(_cls, type) and issubclass(_cls, docutils.nodes.Node):
+        register_formatter(_cls, getattr(Formatters, _name))
+
+
+def format_lines(width: Optional[int], node: docutils.nodes.Node) -> Iterator[str]:
+    """
+    Generate the lines of the formatted node, without newlines, as they're produced.
+    """
     if width is not None and width <= 0:
         width = None
-    ret = "\n".join(fmt(node, FormatContext(0, width, "", "", [], 0)))
+    format_external_code(node)
+    return fmt(node, FormatContext(0, width, "", "", [], 0))
+
+
+def format_node(width: Optional[int], node: docutils.nodes.Node) -> str:
+    ret = "\n".join(format_lines(width, node))
     if ret:
         ret += "\n"
     return ret
 
 
+def format_to(stream: TextIO, width: Optional[int], node: docutils.nodes.Node) -> None:
+    """
+    Write the formatted node to the stream line by line, which avoids holding the whole output in
+    memory. The result is the same as writing `format_node(width, node)`.
+    """
+    write = stream.write
+    for line in format_lines(width, node):
+        write(line + "\n")
+
+
+def top_level_blocks(
+    node: docutils.nodes.Node, ctx: FormatContext
+) -> Iterator[Tuple[docutils.nodes.Node, FormatContext]]:
+    """
+    Yield the body elements and titles that make up a document with its sections flattened out,
+    along with the context to format each one in. Formatting these and separating them with blank
+    lines gives the same result as formatting the whole document.
+    """
+    for c in node.children:
+        if isinstance(c, docutils.nodes.section):
+            yield from top_level_blocks(c, ctx.in_section())
+        else:
+            yield c, ctx
+
+
+def top_level_starts(lines: List[str]) -> List[int]:
+    """
+    Return the (zero-based) numbers of the lines where a top-level element could start: the first
+    nonblank line, and unindented lines following a blank line.
+    """
+    starts: List[int] = []
+    for i, line in enumerate(lines):
+        if line.strip() and (
+            not starts or (not line[0].isspace() and (i == 0 or not lines[i - 1].strip()))
+        ):
+            starts.append(i)
+    return starts
+
+
+BlockGroup = Tuple[int, List[Tuple[docutils.nodes.Node, FormatContext]]]
+
+
+def group_blocks(
+    width: Optional[int], node: docutils.nodes.document, starts: List[int]
+) -> List[BlockGroup]:
+    """
+    Match up the top-level elements of a document with the pieces of its source that begin at the
+    given start lines, returning groups of elements along with the index of the first piece each
+    group covers. Each group covers the pieces up to the next group's first piece.
+
+    Elements are placed using the line numbers Docutils records. Some nodes record a line after
+    their start rather than the start itself, and preprocessing can reorder nodes, so elements that
+    can't be placed on their own are grouped with their neighbors.
+    """
+    groups: List[BlockGroup] = []
+    for block, ctx in top_level_blocks(node, FormatContext(0, width, "", "", [], 0)):
+        if block.line is None:
+            piece = groups[-1][0] if groups else 0
+        else:
+            piece = max(0, bisect.bisect_right(starts, block.line - 1) - 1)
+        members = [(block, ctx)]
+        # Merge with the previous groups until this one starts after them.
+        while groups and piece <= groups[-1][0]:
+            prev_piece, prev_members = groups.pop()
+            piece = min(piece, prev_piece)
+            members = prev_members + members
+        groups.append((piece, members))
+    return groups
+
+
+def fmt_group(members: List[Tuple[docutils.nodes.Node, FormatContext]]) -> List[str]:
+    for block, _ in members:
+        format_external_code(block)
+    return list(chain_intersperse("", (fmt(block, ctx) for block, ctx in members)))
+
+
+def format_ranges(
+    width: Optional[int],
+    node: docutils.nodes.document,
+    source: str,
+    line_ranges: Iterable[Tuple[int, int]],
+) -> str:
+    """
+    Format only the top-level elements of a document that overlap the given line ranges, leaving the
+    rest of its source as it is. The ranges are one-based and inclusive at both ends.
+
+    The source is split into pieces at the lines where top-level elements can start, and the
+    elements are matched up with the pieces by `group_blocks`; a group of elements is formatted or
+    left alone as a whole.
+    """
+    if width is not None and width <= 0:
+        width = None
+    lines = source.splitlines(keepends=True)
+    line_ranges = list(line_ranges)
+
+    starts = top_level_starts(lines)
+    if not starts:
+        return source
+    groups = group_blocks(width, node, starts)
+
+    def overlaps(first: int, last: int) -> bool:
+        return any(first <= end and last >= start for start, end in line_ranges)
+
+    out = lines[: starts[groups[0][0]]] if groups else lines
+    for i, (piece, members) in enumerate(groups):
+        begin = starts[piece]
+        end = starts[groups[i + 1][0]] if i + 1 < len(groups) else len(lines)
+        last = end
+        while last > begin and not lines[last - 1].strip():
+            last -= 1
+
+        if not overlaps(begin + 1, last):
+            out.extend(lines[begin:end])
+            continue
+        out.append("\n".join(fmt_group(members)) + "\n")
+        if i + 1 < len(groups):
+            out.append("\n")
+    return "".join(out)
+
+
+class Block(NamedTuple):
+    """
+    A formatted group of top-level elements, as used by `IncrementalFormatter`.
+    """
+
+    # The pieces of the source that the elements came from (see `top_level_starts`).
+    pieces: Tuple[str, ...]
+    lines: List[str]
+    # Whether the elements include a section title (possibly inside a directive), which can't be
+    # reparsed out of context, or a target, which can be reordered with its neighbors.
+    has_title: bool
+    has_target: bool
+
+
+def split_pieces(source: str) -> Tuple[str, List[str]]:
+    """
+    Split a source into the text before the first place an element could start, and the pieces
+    beginning at each such place.
+    """
+    lines = source.splitlines(keepends=True)
+    bounds = top_level_starts(lines) + [len(lines)]
+    pieces = ["".join(lines[a:b]) for a, b in pairwise(bounds)]
+    return "".join(lines[: bounds[0]]), pieces
+
+
+def contains(node: docutils.nodes.Node, cls: type) -> bool:
+    stack = [node]
+    while stack:
+        n = stack.pop()
+        if isinstance(n, cls):
+            return True
+        stack.extend(n.children)
+    return False
+
+
+def format_blocks(
+    width: Optional[int], source: str, titles: bool = True
+) -> Optional[Tuple[str, List[Block]]]:
+    """
+    Parse and format a source, returning the text before its first element along with the formatted
+    blocks. If `titles` is false and the source contains any section titles, return None instead.
+    """
+    if width is not None and width <= 0:
+        width = None
+    if not source.strip():
+        return source, []
+    doc = parse_string(source)
+    if not titles and contains(doc, docutils.nodes.title):
+        return None
+
+    lines = source.splitlines(keepends=True)
+    starts = top_level_starts(lines)
+    groups = group_blocks(width, doc, starts)
+    # Pieces that didn't produce any elements still have to belong to some block.
+    bounds = [0] + [piece for piece, _ in groups[1:]] + [len(starts)]
+    blocks = []
+    for (_, members), piece, end in zip(groups, bounds, bounds[1:]):
+        pieces = tuple(
+            "".join(lines[starts[i] : starts[i + 1] if i + 1 < len(starts) else len(lines)])
+            for i in range(piece, end)
+        )
+        nodes = [block for block, _ in members]
+        blocks.append(
+            Block(
+                pieces,
+                fmt_group(members),
+                any(contains(n, docutils.nodes.title) for n in nodes),
+                any(isinstance(n, docutils.nodes.target) for n in nodes),
+            )
+        )
+    return "".join(lines[: starts[0]] if starts else lines), blocks
+
+
+class IncrementalPlan(NamedTuple):
+    """
+    What needs to be reformatted to bring an `IncrementalFormatter` up to date with a new source: the
+    text to pass to `format_blocks`, and the blocks from the previous version to keep around it.
+    """
+
+    source: str
+    text: str
+    full: bool
+    before: List[Block]
+    after: List[Block]
+
+
+class IncrementalFormatter:
+    """
+    Formats successive versions of a document, reparsing and reformatting only the parts that have
+    changed since the previous version.
+
+    The source is split into pieces at the places where top-level elements can start, and the
+    formatted output is kept for each group of elements along with the pieces it came from. On a new
+    version, the changed pieces are found by comparing with the old ones from both ends, and those,
+    along with a group of context on either side (which is enough for, e.g., an added item to join
+    the list before it), are parsed and formatted on their own. Anything involving section titles
+    falls back to formatting the whole document, since titles can't be parsed out of context.
+
+    `format` does everything in one go; `plan` and `apply` split it up so that the parsing and
+    formatting in between can happen elsewhere, such as in a worker process.
+    """
+
+    def __init__(self, width: Optional[int]) -> None:
+        self.width = width
+        self._preamble: Optional[str] = None
+        self._blocks: List[Block] = []
+
+    def plan(self, source: str, full: bool = False) -> IncrementalPlan:
+        preamble, new = split_pieces(source)
+        blocks = self._blocks
+        if full or preamble != self._preamble or not blocks:
+            return IncrementalPlan(source, source, True, [], [])
+
+        old = [p for b in blocks for p in b.pieces]
+        owner = [i for i, b in enumerate(blocks) for _ in b.pieces]
+        n = min(len(old), len(new))
+        prefix = 0
+        while prefix < n and old[prefix] == new[prefix]:
+            prefix += 1
+        if prefix == len(old) == len(new):
+            return IncrementalPlan(source, "", False, blocks, [])
+        suffix = 0
+        while suffix < n - prefix and old[-1 - suffix] == new[-1 - suffix]:
+            suffix += 1
+
+        # Find the blocks touched by the change.
+        if prefix < len(old) - suffix:
+            first, last = owner[prefix], owner[len(old) - suffix - 1]
+        elif 0 < prefix < len(old) and owner[prefix - 1] == owner[prefix]:
+            # An insertion in the middle of a block.
+            first = last = owner[prefix]
+        else:
+            # An insertion between blocks, which touches neither of them.
+            first = owner[prefix] if prefix < len(old) else len(blocks)
+            last = first - 1
+
+        # Add a block of context on either side, so that, e.g., an added item can join the list
+        # before it. Titles don't need to be included, since nothing continues across them.
+        def mergeable(i: int) -> bool:
+            return 0 <= i < len(blocks) and not blocks[i].has_title
+
+        if mergeable(first - 1):
+            first -= 1
+        if mergeable(last + 1):
+            last += 1
+        # An unindented "quoted" literal block depends on the paragraph before it ending with "::".
+        while first > 0 and blocks[first - 1].pieces[-1].rstrip().endswith("::"):
+            first -= 1
+        # A run of targets is sorted as a whole, so it has to be reformatted as a whole.
+        while mergeable(first - 1) and first <= last and blocks[first].has_target:
+            first -= 1
+        while mergeable(last + 1) and first <= last and blocks[last].has_target:
+            last += 1
+        if any(b.has_title for b in blocks[first : last + 1]):
+            return IncrementalPlan(source, source, True, [], [])
+
+        start = sum(len(b.pieces) for b in blocks[:first])
+        end = sum(len(b.pieces) for b in blocks[: last + 1]) + len(new) - len(old)
+        text = "".join(new[start:end])
+        return IncrementalPlan(source, text, False, blocks[:first], blocks[last + 1 :])
+
+    def apply(self, plan: IncrementalPlan, result: Tuple[str, List[Block]]) -> str:
+        preamble, blocks = result
+        if plan.full:
+            self._preamble = preamble
+        else:
+            blocks = plan.before + blocks + plan.after
+        self._blocks = blocks
+        ret = "\n".join(chain_intersperse("", (b.lines for b in blocks)))
+        if ret:
+            ret += "\n"
+        return ret
+
+    def format(self, source: str) -> str:
+        plan = self.plan(source)
+        result = format_changes(self.width, plan.text, plan.full)
+        if result is None:
+            plan = self.plan(source, full=True)
+            result = format_changes(self.width, plan.text, plan.full)
+        assert result is not None
+        return self.apply(plan, result)
+
+
+def format_changes(
+    width: Optional[int], text: str, full: bool
+) -> Optional[Tuple[str, List[Block]]]:
+    """
+    Do the parsing and formatting for an `IncrementalPlan`, returning None if the plan has to be
+    redone with `full` set.
+    """
+    if full:
+        return format_blocks(width, text)
+    try:
+        return format_blocks(width, text, titles=False)
+    except docutils.utils.SystemMessage:
+        # The error may just come from parsing the changed part out of context.
+        return None
+
+
+class _RoleRegistry(dict):  # type: ignore
+    """
+    Docutils' registry of roles, with the default role kept separately for each thread.
+
+    The `default-role` directive sets the default role in the registry, which is global, so two
+    threads parsing at once would otherwise see each other's.
+    """
+
+    def __init__(self, roles: Dict[str, Any]) -> None:
+        super().__init__(roles)
+        super().pop("", None)
+        self._local = threading.local()
+
+    def __contains__(self, name: object) -> bool:
+        if name == "":
+            return hasattr(self._local, "default")
+        return super().__contains__(name)
+
+    def __getitem__(self, name: str) -> Any:
+        if name == "":
+            try:
+                return self._local.default
+            except AttributeError:
+                raise KeyError(name) from None
+        return super().__getitem__(name)
+
+    def __setitem__(self, name: str, role: Any) -> None:
+        if name == "":
+            self._local.default = role
+        else:
+            super().__setitem__(name, role)
+
+    def __delitem__(self, name: str) -> None:
+        if name == "":
+            if not hasattr(self._local, "default"):
+                raise KeyError(name)
+            del self._local.default
+        else:
+            super().__delitem__(name)
+
+    def get(self, name: str, default: Any = None) -> Any:
+        return self[name] if name in self else default
+
+    def pop(self, name: str, *default: Any) -> Any:
+        if name == "":
+            if name in self:
+                role = self[name]
+                del self[name]
+                return role
+            if default:
+                return default[0]
+            raise KeyError(name)
+        return super().pop(name, *default)
+
+
+def _install_role_registry() -> None:
+    roles = docutils.parsers.rst.roles
+    if not isinstance(roles._roles, _RoleRegistry):
+        roles._roles = _RoleRegistry(roles._roles)
+
+
+class ParseContext:
+    """
+    Reusable state for parsing documents.
+
+    Building the settings object and the parser's state machine accounts for a large fraction of the
+    time taken to parse a small document, so we build them once and reset only the per-document
+    parts for each parse. A context must only be used by one thread; `get_parse_context` returns a
+    separate one for each.
+    """
+
+    def __init__(self) -> None:
+        _install_role_registry()
+        settings = docutils.frontend.OptionParser(
+            components=[docutils.parsers.rst.Parser]
+        ).get_default_values()
+        settings.report_level = docutils.utils.Reporter.SEVERE_LEVEL
+        settings.halt_level = docutils.utils.Reporter.WARNING_LEVEL
+        settings.file_insertion_enabled = False
+        self.settings = settings
+        self.parser = docutils.parsers.rst.Parser()
+        self.state_machine = self._new_state_machine()
+        self.in_use = False
+
+    def _new_state_machine(self) -> docutils.parsers.rst.states.RSTStateMachine:
+        return docutils.parsers.rst.states.RSTStateMachine(
+            state_classes=self.parser.state_classes, initial_state=self.parser.initial_state
+        )
+
+    def new_document(self) -> docutils.nodes.document:
+        settings = self.settings
+        reporter = IgnoreMessagesReporter("", settings.report_level, settings.halt_level)
+        doc = docutils.nodes.document(settings, reporter, source="")
+        doc.note_source("", -1)
+        return doc
+
+    def parse(self, s: str) -> docutils.nodes.document:
+        doc = self.new_document()
+
+        # Parsing shouldn't recurse into this context, but if it somehow does, fall back to a fresh
+        # state machine rather than clobbering the one in progress.
+        state_machine = self._new_state_machine() if self.in_use else self.state_machine
+        self.in_use = True
+
+        # This mirrors `docutils.parsers.rst.Parser.parse`, minus creating the state machine.
+        self.parser.setup_parse(s, doc)
+        try:
+            lines = docutils.statemachine.string2lines(
+                s, tab_width=self.settings.tab_width, convert_whitespace=True
+            )
+            limit = getattr(self.settings, "line_length_limit", None)
+            too_long = [
+                i for i, line in enumerate(lines) if limit is not None and len(line) > limit
+            ]
+            if too_long:
+                msg = f"Line {too_long[0] + 1} exceeds the line-length-limit."
+                doc.append(doc.reporter.error(msg))
+            else:
+                state_machine.run(lines, doc, inliner=self.parser.inliner)
+        finally:
+            # Drop anything that refers to this document so the state machine can be reused.
+            state_machine.observers = []
+            state_machine.node = state_machine.memo = None
+            if state_machine is self.state_machine:
+                self.in_use = False
+            # The `default-role` directive sets the default role for this thread; restore it after
+            # each document.
+            docutils.parsers.rst.roles._roles.pop("", None)
+            self.parser.finish_parse()
+
+        return doc
+
+
+_parse_contexts = threading.local()
+
+
+def get_parse_context() -> ParseContext:
+    context: Optional[ParseContext] = getattr(_parse_contexts, "context", None)
+    if context is None:
+        context = _parse_contexts.context = ParseContext()
+    return context
+
+
 def parse_string(s: str) -> docutils.nodes.document:
-    parser = docutils.parsers.rst.Parser()
-    settings = docutils.frontend.OptionParser(
-        components=[docutils.parsers.rst.Parser]
-    ).get_default_values()
-    settings.report_level = docutils.utils.Reporter.SEVERE_LEVEL
-    settings.halt_level = docutils.utils.Reporter.WARNING_LEVEL
-    settings.file_insertion_enabled = False
-    doc = docutils.utils.new_document("", settings=settings)
-    doc.reporter = IgnoreMessagesReporter("", settings.report_level, settings.halt_level)
-    parser.parse(s, doc)
+    doc = get_parse_context().parse(s)
     preproc(doc)
 
     return doc
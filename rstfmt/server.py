@@ -1,65 +1,886 @@
 import argparse
 import asyncio
 import functools
+import inspect
+import json
 import logging
+import os
+import sys
+import threading
 import time
+from collections import OrderedDict
 from concurrent import futures
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Set, Tuple, TypeVar
 
 import docutils
 
 from aiohttp import web
 
-from . import rst_extras, rstfmt
+from . import cache, metrics, profiling, rst_extras, rstfmt
 
+T = TypeVar("T")
 
-class ParseError(Exception):
-    pass
+log = logging.getLogger("rstfmtd")
 
+# How many of the slowest documents to remember when profiling.
+PROFILE_FILES = 100
+
+
+class FormatResult(NamedTuple):
+    text: str
+    # When the worker picked up the job, according to `time.time`.
+    started: float
+    # Time spent in each phase, in seconds. Code formatting happens as part of formatting, but isn't
+    # included in `format_time`.
+    parse_time: float
+    format_time: float
+    code_time: float
+    code_hits: int
+    code_misses: int
+    # Only set when profiling.
+    profile: Optional[profiling.Profile] = None
+
+
+def do_format(width: int, s: str, profile: bool = False) -> FormatResult:
+    if profile:
+        with profiling.recording() as p:
+            return do_format(width, s)._replace(profile=p)
+
+    started = time.time()
+    # These totals are shared by the whole process, so with worker threads they also pick up code
+    # formatted by any other jobs running at the same time.
+    code_cache = rstfmt.code_cache
+    hits, misses = code_cache.hits, code_cache.misses
+    code_time = sum(code_cache.format_time.values())
 
-def do_format(width: int, s: str) -> str:
-    # Unpickling SystemMessage objects is broken for some reason, so raising them directly fails;
-    # replace them with our own sentinel class.
     try:
-        return rstfmt.format_node(width, rstfmt.parse_string(s))
+        with profiling.file_timer("") as timer:
+            t0 = time.perf_counter()
+            with timer.phase("parse"):
+                doc = rstfmt.get_parse_context().parse(s)
+            with timer.phase("preproc"):
+                rstfmt.preproc(doc)
+            t1 = time.perf_counter()
+            with timer.phase("format"):
+                text = rstfmt.format_node(width, doc)
+            t2 = time.perf_counter()
     except docutils.utils.SystemMessage as e:
-        raise ParseError(str(e))
+        raise rstfmt.ParseError(str(e))
+
+    code_time = sum(code_cache.format_time.values()) - code_time
+    return FormatResult(
+        text,
+        started,
+        t1 - t0,
+        max(0.0, t2 - t1 - code_time),
+        code_time,
+        code_cache.hits - hits,
+        code_cache.misses - misses,
+    )
+
+
+def do_format_changes(
+    width: int, text: str, full: bool
+) -> Optional[Tuple[str, List[rstfmt.Block]]]:
+    try:
+        return rstfmt.format_changes(width, text, full)
+    except docutils.utils.SystemMessage as e:
+        raise rstfmt.ParseError(str(e))
+
+
+def do_format_changes_profiled(
+    width: int, text: str, full: bool
+) -> Tuple[Optional[Tuple[str, List[rstfmt.Block]]], profiling.Profile]:
+    # Parsing only the changed parts happens inside `format_changes`, so it all counts as formatting.
+    with profiling.recording() as p:
+        with profiling.file_timer("") as timer, timer.phase("format"):
+            result = do_format_changes(width, text, full)
+    return result, p
+
+
+# Formatted by each worker when it starts, to get the imports and first-use setup that would otherwise
+# slow down the first real requests out of the way.
+CANARY = """\
+Warm-up
+=======
+
+See :func:`format_node` and :ref:`usage`.
+
+.. note::
+
+   A *note* with a `link <https://example.com>`_.
+
+.. code-block:: python
+
+   def f(x): return x
+"""
+
+
+def init_worker(
+    disk_cache: Optional[cache.Cache], warm_up: bool = True, profile: bool = False
+) -> None:
+    # Registration can't be left to inheritance from the parent, since workers aren't necessarily
+    # forked; warming up only adds registering everything ahead of time.
+    rst_extras.register()
+    if warm_up:
+        rst_extras.register_all()
+        # Do this before attaching the disk cache, so that Black actually gets run.
+        rstfmt.format_node(72, rstfmt.parse_string(CANARY))
+    rstfmt.code_cache.disk = disk_cache
+    if profile:
+        profiling.instrument()
+
+
+_thread_setup_lock = threading.Lock()
+_thread_setup_done = False
+
+
+def init_thread(
+    disk_cache: Optional[cache.Cache], warm_up: bool = True, profile: bool = False
+) -> None:
+    """
+    Set up a worker thread. The setup in `init_worker` applies to the whole process, so it's only
+    done by the first thread; each thread still has its own parse context to warm up.
+    """
+    global _thread_setup_done
+    with _thread_setup_lock:
+        if not _thread_setup_done:
+            init_worker(disk_cache, warm_up, profile)
+            _thread_setup_done = True
+    if warm_up:
+        rstfmt.parse_string(CANARY)
+
+
+def max_rss() -> int:
+    """
+    Return the peak memory usage of this process in bytes, or 0 if it can't be measured.
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes; macOS reports bytes.
+    return rss if sys.platform == "darwin" else 1024 * rss
+
+
+def run_job(func: Callable[..., T], *args: Any) -> Tuple[T, int]:
+    return func(*args), max_rss()
+
+
+def ping() -> Tuple[int, int]:
+    # Identifies the worker, whether it's a process or a thread.
+    return os.getpid(), threading.get_ident()
+
+
+class WorkerPool:
+    """
+    A pool of worker processes that are warmed up before they take requests, and replaced once
+    they've run too many jobs or used too much memory.
+
+    `ProcessPoolExecutor` can't replace individual workers, so the whole pool is replaced at once: a
+    new one is started and warmed up while the old one finishes the jobs it already has.
+
+    With `executor="thread"`, the workers are threads in this process instead. That saves pickling
+    each job and its result, which matters most for small documents, but the threads share the GIL
+    and replacing them doesn't give back any memory.
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        disk: Optional[cache.Cache] = None,
+        *,
+        warm_up: bool = True,
+        max_tasks: int = 0,
+        max_rss: int = 0,
+        profile: bool = False,
+        executor: str = "process",
+    ) -> None:
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = executor
+        self.disk = disk
+        self.warm_up = warm_up
+        self.profile = profile
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss
+        self.ready = False
+        self.recycles = 0
+        self._tasks = 0
+        self._recycling = False
+        self._executor = self._new_executor()
+
+    def _new_executor(self) -> futures.Executor:
+        initargs = (self.disk, self.warm_up, self.profile)
+        if self.executor == "thread":
+            return futures.ThreadPoolExecutor(
+                self.workers, initializer=init_thread, initargs=initargs
+            )
+        return futures.ProcessPoolExecutor(self.workers, initializer=init_worker, initargs=initargs)
+
+    async def _start(self, executor: futures.Executor) -> None:
+        # Workers run their initializer before their first job, so a worker that has answered a
+        # ping is warmed up. Submitting a ping for each worker at once makes the executor start them
+        # all, but one that's already warm can answer several while another is still starting, so
+        # keep pinging until every worker has answered.
+        loop = asyncio.get_event_loop()
+        answered: Set[Tuple[int, int]] = set()
+        while True:
+            answered.update(
+                await asyncio.gather(
+                    *(loop.run_in_executor(executor, ping) for _ in range(self.workers))
+                )
+            )
+            if len(answered) >= self.workers:
+                return
+            await asyncio.sleep(0.05)
+
+    async def start(self) -> None:
+        t0 = time.perf_counter()
+        await self._start(self._executor)
+        self.ready = True
+        dt = int(1000 * (time.perf_counter() - t0))
+        log.info("workers ready executor=%s workers=%d ms=%d", self.executor, self.workers, dt)
+
+    async def _recycle(self, reason: str) -> None:
+        if self._recycling:
+            return
+        self._recycling = True
+        try:
+            log.info("replacing workers reason=%s", reason)
+            executor = self._new_executor()
+            await self._start(executor)
+            old, self._executor = self._executor, executor
+            self._tasks = 0
+            self.recycles += 1
+            old.shutdown(wait=False)
+        finally:
+            self._recycling = False
+
+    async def run(self, func: Callable[..., T], *args: Any) -> T:
+        loop = asyncio.get_event_loop()
+        executor = self._executor
+        self._tasks += 1
+        try:
+            result, rss = await loop.run_in_executor(executor, run_job, func, *args)
+        except futures.BrokenExecutor:
+            if executor is self._executor:
+                asyncio.ensure_future(self._recycle("broken"))
+            raise
+
+        if executor is self._executor:
+            if self.max_rss and rss > self.max_rss:
+                asyncio.ensure_future(self._recycle("memory"))
+            elif self.max_tasks and self._tasks >= self.max_tasks * self.workers:
+                asyncio.ensure_future(self._recycle("tasks"))
+        return result
+
+    def shutdown(self) -> None:
+        self._executor.shutdown()
+
+
+class ServerMetrics:
+    def __init__(self, formatter: "Formatter") -> None:
+        r = self.registry = metrics.Registry()
+        self.requests = r.add(
+            metrics.Counter("rstfmtd_requests_total", "HTTP requests, by endpoint and status.")
+        )
+        self.documents = r.add(
+            metrics.Counter("rstfmtd_documents_total", "Documents formatted, by status.")
+        )
+        self.request_seconds = r.add(
+            metrics.Histogram("rstfmtd_request_seconds", "Request latency, by endpoint.")
+        )
+        self.phase_seconds = r.add(
+            metrics.Histogram(
+                "rstfmtd_phase_seconds",
+                "Time per document spent waiting for a worker (queue), parsing (parse), formatting"
+                " (format), and running code formatters (code).",
+            )
+        )
+        self.body_bytes = r.add(
+            metrics.Histogram(
+                "rstfmtd_document_bytes", "Size of documents received.", metrics.SIZE_BUCKETS
+            )
+        )
+        self.cache = r.add(
+            metrics.Counter(
+                "rstfmtd_cache_lookups_total",
+                "Cache lookups, by cache (response or code) and result (hit, disk_hit, coalesced,"
+                " or miss).",
+            )
+        )
+        r.add(
+            metrics.Gauge(
+                "rstfmtd_executor_jobs",
+                "Jobs submitted to the worker pool that haven't finished yet.",
+                lambda: formatter.in_flight,
+            )
+        )
+        r.add(
+            metrics.Gauge(
+                "rstfmtd_ready",
+                "Whether the workers have finished warming up.",
+                lambda: formatter.pool.ready,
+            )
+        )
+        r.add(
+            metrics.Gauge(
+                "rstfmtd_worker_recycles",
+                "How many times the worker pool has been replaced.",
+                lambda: formatter.pool.recycles,
+            )
+        )
+
+    def observe_result(self, submitted: float, result: FormatResult) -> None:
+        self.phase_seconds.observe(max(0.0, result.started - submitted), phase="queue")
+        self.phase_seconds.observe(result.parse_time, phase="parse")
+        self.phase_seconds.observe(result.format_time, phase="format")
+        self.phase_seconds.observe(result.code_time, phase="code")
+        self.cache.inc(result.code_hits, cache="code", result="hit")
+        self.cache.inc(result.code_misses, cache="code", result="miss")
+
+
+def document_name(text: str) -> str:
+    """
+    Describe a document for the profile, which has nothing else to call it by.
+    """
+    first = next((line.strip() for line in text.splitlines() if line.strip()), "")
+    return f"{first[:40]!r} ({len(text)} chars)"
+
+
+class _Job:
+    def __init__(self, task: "asyncio.Future[str]") -> None:
+        self.task = task
+        self.waiters = 0
+
+
+class Formatter:
+    """
+    Runs formatting jobs on the worker pool.
+
+    Results are cached in a bounded LRU keyed by width and a hash of the input (which also covers
+    the versions of everything that affects formatting), and concurrent requests for the same input
+    share a single job. If `disk` is set, results are also stored there so they survive restarts.
+
+    Requests that give a document id are formatted incrementally, reusing the results for the parts
+    of the document that haven't changed since the last request with the same id; the state for the
+    `documents_size` most recently used documents is kept.
+
+    If `profile` is set, the workers' timings for each job are collected into it.
+    """
+
+    def __init__(
+        self,
+        pool: WorkerPool,
+        cache_size: int = 1024,
+        disk: Optional[cache.Cache] = None,
+        documents_size: int = 256,
+        profile: Optional[profiling.Profile] = None,
+    ) -> None:
+        self.pool = pool
+        self.cache_size = cache_size
+        self.disk = disk
+        self.documents_size = documents_size
+        self._documents: "OrderedDict[Tuple[str, int], rstfmt.IncrementalFormatter]" = OrderedDict()
+        self._results: "OrderedDict[str, str]" = OrderedDict()
+        self._pending: Dict[str, _Job] = {}
+        self.in_flight = 0
+        self.metrics = ServerMetrics(self)
+        self.profile = profile
+
+    def _add_profile(self, name: str, profile: profiling.Profile) -> None:
+        if self.profile is not None:
+            profile.files = [(name, times) for _, times in profile.files]
+            self.profile.merge(profile)
 
+    async def _run(self, width: int, text: str) -> str:
+        self.in_flight += 1
+        try:
+            submitted = time.time()
+            result = await self.pool.run(do_format, width, text, self.profile is not None)
+        finally:
+            self.in_flight -= 1
+        self.metrics.observe_result(submitted, result)
+        if result.profile is not None:
+            self._add_profile(document_name(text), result.profile)
+        return result.text
 
-async def handle(pool: futures.Executor, req: web.Request) -> web.Response:
-    width = int(req.headers.get("X-Line-Length", 72))
-    body = await req.text()
+    async def _format_changes(
+        self, doc_id: str, width: int, plan: rstfmt.IncrementalPlan
+    ) -> Optional[Tuple[str, List[rstfmt.Block]]]:
+        if self.profile is None:
+            return await self.pool.run(do_format_changes, width, plan.text, plan.full)
+        result, profile = await self.pool.run(
+            do_format_changes_profiled, width, plan.text, plan.full
+        )
+        self._add_profile(doc_id, profile)
+        return result
+
+    async def _run_incremental(self, doc_id: str, width: int, text: str) -> str:
+        key = (doc_id, width)
+        inc = self._documents.get(key)
+        if inc is None:
+            inc = self._documents[key] = rstfmt.IncrementalFormatter(width)
+            if len(self._documents) > self.documents_size:
+                self._documents.popitem(last=False)
+        self._documents.move_to_end(key)
+
+        self.in_flight += 1
+        try:
+            plan = inc.plan(text)
+            result = await self._format_changes(doc_id, width, plan)
+            if result is None:
+                plan = inc.plan(text, full=True)
+                result = await self._format_changes(doc_id, width, plan)
+        finally:
+            self.in_flight -= 1
+        assert result is not None
+        return inc.apply(plan, result)
+
+    async def _compute(self, key: str, width: int, text: str, doc_id: Optional[str]) -> str:
+        loop = asyncio.get_event_loop()
+        lookups = self.metrics.cache
+
+        result = None
+        if self.disk is not None:
+            value = await loop.run_in_executor(None, self.disk.get, key)
+            if value is not None:
+                result = value.decode("utf-8", "surrogatepass")
+                lookups.inc(cache="response", result="disk_hit")
+        if result is None:
+            lookups.inc(cache="response", result="miss")
+            if doc_id is None:
+                result = await self._run(width, text)
+            else:
+                result = await self._run_incremental(doc_id, width, text)
+            if self.disk is not None:
+                value = result.encode("utf-8", "surrogatepass")
+                await loop.run_in_executor(None, self.disk.put, key, value)
+
+        if self.cache_size > 0:
+            self._results[key] = result
+            if len(self._results) > self.cache_size:
+                self._results.popitem(last=False)
+        return result
+
+    async def format(self, width: int, text: str, doc_id: Optional[str] = None) -> str:
+        key = cache.make_key("response", rstfmt.code_formatter_versions(), str(width), text)
+
+        result = self._results.get(key)
+        if result is not None:
+            self._results.move_to_end(key)
+            self.metrics.cache.inc(cache="response", result="hit")
+            return result
+
+        job = self._pending.get(key)
+        if job is None:
+            job = self._pending[key] = _Job(
+                asyncio.ensure_future(self._compute(key, width, text, doc_id))
+            )
+            job.task.add_done_callback(lambda _: self._pending.pop(key, None))
+        else:
+            self.metrics.cache.inc(cache="response", result="coalesced")
+
+        # Shield the shared job so that one waiter going away doesn't cancel it for the others, but
+        # do cancel it once nobody is waiting for it anymore, so it doesn't hold up other work.
+        job.waiters += 1
+        try:
+            return await asyncio.shield(job.task)
+        finally:
+            job.waiters -= 1
+            if job.waiters == 0 and not job.task.done():
+                job.task.cancel()
+                if self._pending.get(key) is job:
+                    del self._pending[key]
+
+
+class Limits:
+    """
+    Admission control and deadlines for requests.
+
+    At most `max_documents` documents are worked on at once (0 for no limit); requests beyond that
+    are turned away right away with a 503, rather than queueing up behind each other. A batch larger
+    than the limit is still let in when nothing else is running. Formatting gives up after the
+    number of seconds in the request's `X-Timeout` header, or `timeout` if there isn't one.
+
+    Single documents are limited to `max_body_size` bytes (0 for no limit). The application's own
+    limit is set high enough for batches, which are much larger, so this enforces the smaller one.
+    """
+
+    def __init__(
+        self,
+        max_documents: int = 0,
+        timeout: float = 0,
+        retry_after: int = 1,
+        max_body_size: int = 0,
+    ) -> None:
+        self.max_documents = max_documents
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.max_body_size = max_body_size
+        self.documents = 0
+
+    def full(self) -> bool:
+        return bool(self.max_documents) and self.documents >= self.max_documents
+
+    def admit(self, n: int = 1) -> bool:
+        if self.max_documents and self.documents and self.documents + n > self.max_documents:
+            return False
+        self.documents += n
+        return True
+
+    def release(self, n: int = 1) -> None:
+        self.documents -= n
+
+    def check_body_size(self, size: Optional[int]) -> None:
+        # Rejected the same way aiohttp rejects bodies over the application's limit.
+        if self.max_body_size and size is not None and size > self.max_body_size:
+            raise web.HTTPRequestEntityTooLarge(max_size=self.max_body_size, actual_size=size)
+
+    def overloaded(self) -> web.Response:
+        return web.Response(
+            status=503,
+            reason="Too many documents in progress",
+            headers={"Retry-After": str(self.retry_after)},
+        )
+
+    def deadline(self, req: web.Request) -> Optional[float]:
+        """
+        Return the time, according to the event loop, by which the request should be done.
+        """
+        timeout = float(req.headers.get("X-Timeout", self.timeout))
+        if timeout <= 0:
+            return None
+        return asyncio.get_event_loop().time() + timeout
+
+
+async def format_until(
+    formatter: Formatter,
+    deadline: Optional[float],
+    width: int,
+    text: str,
+    doc_id: Optional[str] = None,
+) -> str:
+    if deadline is None:
+        return await formatter.format(width, text, doc_id)
+    timeout = max(0.0, deadline - asyncio.get_event_loop().time())
+    return await asyncio.wait_for(formatter.format(width, text, doc_id), timeout)
+
+
+def error_response(status: int, message: str) -> web.Response:
+    # The reason can't contain line breaks, which Docutils messages usually do, so it only gets the
+    # first line; the whole message goes in the body.
+    reason = message.splitlines()[0] if message else None
+    return web.Response(status=status, reason=reason, text=message + "\n")
+
+
+async def handle(formatter: Formatter, limits: Limits, req: web.Request) -> web.Response:
+    try:
+        width = int(req.headers.get("X-Line-Length", 72))
+        deadline = limits.deadline(req)
+    except ValueError as e:
+        return web.Response(status=400, reason=f"Invalid header: {e}")
+
+    limits.check_body_size(req.content_length)
+    if not limits.admit():
+        formatter.metrics.requests.inc(endpoint="/", status="503")
+        return limits.overloaded()
+
+    try:
+        # The length isn't known up front for chunked bodies.
+        limits.check_body_size(len(await req.read()))
+        body = await req.text()
+
+        t0 = time.perf_counter()
+
+        try:
+            doc_id = req.headers.get("X-Document-Id")
+            text = await format_until(formatter, deadline, width, body, doc_id)
+            resp = web.Response(text=text)
+        except rstfmt.ParseError as e:
+            log.warning(f"Failed to parse input: {e}")
+            resp = error_response(400, str(e))
+        except asyncio.TimeoutError:
+            resp = web.Response(status=504, reason="Formatting timed out")
+        except Exception as e:
+            log.exception("Error while handling request")
+            resp = error_response(500, str(e))
+
+        t1 = time.perf_counter()
+    finally:
+        limits.release()
+
+    m = formatter.metrics
+    m.requests.inc(endpoint="/", status=str(resp.status))
+    m.documents.inc(status=str(resp.status))
+    m.request_seconds.observe(t1 - t0, endpoint="/")
+    m.body_bytes.observe(len(body))
+    log.info(
+        "finished request endpoint=/ status=%d ms=%d chars=%d width=%d",
+        resp.status,
+        int(1000 * (t1 - t0)),
+        len(body),
+        width,
+    )
+    return resp
+
+
+class BatchDocument(NamedTuple):
+    id: Any
+    width: int
+    text: str
+
+
+def parse_batch(data: Any, default_width: int) -> List[BatchDocument]:
+    if not isinstance(data, dict) or not isinstance(data.get("documents"), list):
+        raise ValueError('expected an object with a "documents" list')
+    docs = []
+    for d in data["documents"]:
+        if not isinstance(d, dict) or not isinstance(d.get("text"), str):
+            raise ValueError('each document must be an object with a "text" string')
+        width = d.get("width", default_width)
+        if not isinstance(width, int):
+            raise ValueError('"width" must be an integer')
+        docs.append(BatchDocument(d.get("id"), width, d["text"]))
+    return docs
+
+
+async def handle_batch(
+    formatter: Formatter, limits: Limits, req: web.Request
+) -> web.StreamResponse:
+    """
+    Format many documents in one request.
+
+    The body is a JSON object like `{"documents": [{"id": ..., "text": ..., "width": ...}, ...]}`,
+    where the width defaults to the `X-Line-Length` header. The documents are formatted in parallel,
+    and the response is a stream of JSON lines, one per document in the order they finish, each with
+    the document's id and either its formatted `text` or an `error` message and HTTP-style `status`.
+    """
+    m = formatter.metrics
+    if limits.full():
+        m.requests.inc(endpoint="/batch", status="503")
+        return limits.overloaded()
+
+    try:
+        default_width = int(req.headers.get("X-Line-Length", 72))
+        deadline = limits.deadline(req)
+        docs = parse_batch(await req.json(), default_width)
+    except ValueError as e:
+        return web.Response(status=400, reason=f"Invalid batch request: {e}")
+
+    if not limits.admit(len(docs)):
+        m.requests.inc(endpoint="/batch", status="503")
+        return limits.overloaded()
 
     t0 = time.perf_counter()
 
+    async def run(doc: BatchDocument) -> Dict[str, Any]:
+        try:
+            text = await format_until(formatter, deadline, doc.width, doc.text)
+            return {"id": doc.id, "text": text}
+        except rstfmt.ParseError as e:
+            log.warning(f"Failed to parse input {doc.id!r}: {e}")
+            return {"id": doc.id, "status": 400, "error": str(e)}
+        except asyncio.TimeoutError:
+            return {"id": doc.id, "status": 504, "error": "Formatting timed out"}
+        except Exception as e:
+            log.exception(f"Error while formatting {doc.id!r}")
+            return {"id": doc.id, "status": 500, "error": str(e)}
+
+    tasks = [asyncio.ensure_future(run(doc)) for doc in docs]
     try:
-        text = await asyncio.get_event_loop().run_in_executor(pool, do_format, width, body)
-        resp = web.Response(text=text)
-    except ParseError as e:
-        logging.warning(f"Failed to parse input: {e}")
-        resp = web.Response(status=400, reason=str(e))
-    except Exception as e:
-        logging.exception("Error while handling request")
-        resp = web.Response(status=500, reason=str(e))
+        resp = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await resp.prepare(req)
+
+        for doc in docs:
+            m.body_bytes.observe(len(doc.text))
+        for fut in asyncio.as_completed(tasks):
+            result = await fut
+            m.documents.inc(status=str(result.get("status", 200)))
+            await resp.write(json.dumps(result).encode("utf-8") + b"\n")
+        await resp.write_eof()
+    finally:
+        # If the client went away, don't leave the rest of the documents queued up.
+        for task in tasks:
+            task.cancel()
+        limits.release(len(docs))
 
     t1 = time.perf_counter()
 
-    dt = int(1000 * (t1 - t0))
-    print(f"Finished request: {dt:3} ms, {len(body):5} chars")
+    m.requests.inc(endpoint="/batch", status=str(resp.status))
+    m.request_seconds.observe(t1 - t0, endpoint="/batch")
+    log.info(
+        "finished request endpoint=/batch status=%d ms=%d chars=%d documents=%d",
+        resp.status,
+        int(1000 * (t1 - t0)),
+        sum(len(doc.text) for doc in docs),
+        len(docs),
+    )
     return resp
 
 
+async def handle_ready(formatter: Formatter, req: web.Request) -> web.Response:
+    if formatter.pool.ready:
+        return web.Response(text="ready\n")
+    return web.Response(status=503, text="warming up\n")
+
+
+async def handle_metrics(formatter: Formatter, req: web.Request) -> web.Response:
+    return web.Response(
+        text=formatter.metrics.registry.render(),
+        content_type="text/plain",
+        headers={"X-Content-Type-Options": "nosniff"},
+    )
+
+
+async def handle_profile(formatter: Formatter, req: web.Request) -> web.Response:
+    if formatter.profile is None:
+        return web.Response(status=404, reason="Profiling is off; start rstfmtd with --profile")
+    output_format = req.query.get("format", "table")
+    if output_format not in ("table", "json"):
+        return web.Response(status=400, reason=f"Unknown format: {output_format}")
+    try:
+        top = int(req.query.get("top", 10))
+    except ValueError as e:
+        return web.Response(status=400, reason=f"Invalid top: {e}")
+    return web.Response(
+        text=formatter.profile.report(output_format, top),
+        content_type="application/json" if output_format == "json" else "text/plain",
+    )
+
+
+def make_app(formatter: Formatter, limits: Limits, client_max_size: int) -> web.Application:
+    async def start(app: web.Application) -> None:
+        # Warm up in the background so that `/ready` can answer in the meantime.
+        asyncio.ensure_future(formatter.pool.start())
+
+    app = web.Application(client_max_size=client_max_size)
+    app.on_startup.append(start)
+    app.add_routes(
+        [
+            web.post("/", functools.partial(handle, formatter, limits)),
+            web.post("/batch", functools.partial(handle_batch, formatter, limits)),
+            web.get("/ready", functools.partial(handle_ready, formatter)),
+            web.get("/metrics", functools.partial(handle_metrics, formatter)),
+            web.get("/profile", functools.partial(handle_profile, formatter)),
+        ]
+    )
+    return app
+
+
 def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("--bind-host", default="localhost")
     parser.add_argument("--bind-port", type=int, default=5219)
+    parser.add_argument(
+        "--no-cache", action="store_true", help="don't use the on-disk cache at all"
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=1024,
+        help="the number of formatted documents to keep in memory (0 to disable)",
+    )
+    parser.add_argument(
+        "--persist-cache",
+        action="store_true",
+        help="also store formatted documents on disk, so they survive restarts",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="the number of worker processes or threads (default: one per CPU)",
+    )
+    parser.add_argument(
+        "--executor",
+        choices=["process", "thread"],
+        default="process",
+        help="run the workers as separate processes (the default) or as threads in this one",
+    )
+    parser.add_argument(
+        "--no-warm-up",
+        action="store_true",
+        help="don't have workers set up everything and format a sample document when they start",
+    )
+    parser.add_argument(
+        "--max-tasks-per-worker",
+        type=int,
+        default=0,
+        help="replace the workers after they've run about this many jobs each (0 for no limit)",
+    )
+    parser.add_argument(
+        "--max-worker-memory",
+        type=int,
+        default=0,
+        help="replace the workers once one has used this many MiB of memory (0 for no limit)",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=0,
+        help="turn away requests while this many documents are being formatted (0 for no limit)",
+    )
+    parser.add_argument(
+        "--max-body-size",
+        type=int,
+        default=1024,
+        help="the largest document to accept, in KiB",
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=64 * 1024,
+        help="the largest request body to accept for /batch, in KiB",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=0,
+        help="give up on requests after this many seconds, unless the X-Timeout header says"
+        " otherwise (0 for no limit)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="time the phases of each job and each node and code formatter, served at /profile",
+    )
     args = parser.parse_args()
+    if args.executor == "thread" and (args.max_tasks_per_worker or args.max_worker_memory):
+        parser.error("replacing the workers only applies to --executor=process")
 
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
     rst_extras.register()
 
-    with futures.ProcessPoolExecutor() as pool:
-        app = web.Application()
-        app.add_routes([web.post("/", functools.partial(handle, pool))])
-        web.run_app(app, host=args.bind_host, port=args.bind_port)
+    disk_cache = None if args.no_cache else cache.Cache(cache.default_path())
+    pool = WorkerPool(
+        args.workers,
+        disk_cache,
+        warm_up=not args.no_warm_up,
+        max_tasks=args.max_tasks_per_worker,
+        max_rss=args.max_worker_memory * 1024 * 1024,
+        profile=args.profile,
+        executor=args.executor,
+    )
+
+    try:
+        formatter = Formatter(
+            pool,
+            args.cache_size,
+            disk_cache if args.persist_cache else None,
+            profile=profiling.Profile(max_files=PROFILE_FILES) if args.profile else None,
+        )
+        limits = Limits(args.max_in_flight, args.timeout, max_body_size=args.max_body_size * 1024)
+        app = make_app(formatter, limits, max(args.max_body_size, args.max_batch_size) * 1024)
+        # Cancel handlers when their clients disconnect, so their queued work is dropped. (This is
+        # the default before aiohttp 3.9, which added the option.)
+        run_args: Dict[str, Any] = {}
+        if "handler_cancellation" in inspect.signature(web.run_app).parameters:
+            run_args["handler_cancellation"] = True
+        web.run_app(app, host=args.bind_host, port=args.bind_port, **run_args)
+    finally:
+        pool.shutdown()
 
 
 if __name__ == "__main__":
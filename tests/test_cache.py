@@ -0,0 +1,85 @@
+import pickle
+import time
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+
+from rstfmt import cache, rstfmt
+
+
+@pytest.fixture
+def db(tmp_path: Path) -> Iterator[cache.Cache]:
+    c = cache.Cache(str(tmp_path / "cache.sqlite3"))
+    yield c
+    c.close()
+
+
+def test_round_trip(db: cache.Cache) -> None:
+    assert db.get("missing") is None
+    db.put("key", b"value")
+    db.put("empty")
+    assert db.get("key") == b"value"
+    assert db.get("empty") == b""
+
+    db.put("key", b"replaced")
+    assert db.get("key") == b"replaced"
+
+
+def test_persists_across_connections(db: cache.Cache) -> None:
+    db.put("key", b"value")
+    db.close()
+    assert cache.Cache(db.path).get("key") == b"value"
+    # Worker processes get a pickled copy, which opens its own connection.
+    assert pickle.loads(pickle.dumps(db)).get("key") == b"value"
+
+
+def test_trim_evicts_least_recently_used(db: cache.Cache, monkeypatch: pytest.MonkeyPatch) -> None:
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+
+    # Each entry is 10 bytes of key and value.
+    db.max_size = 50
+    for i in range(5):
+        now[0] += 1
+        db.put(f"key{i}", b"value")
+    db.trim()
+    assert all(db.get(f"key{i}") is not None for i in range(5))
+
+    # Using an entry long enough after it was written makes it recent again.
+    now[0] += 2 * cache.USED_REFRESH_SECONDS
+    assert db.get("key0") == b"value"
+    now[0] += 1
+    db.put("key5", b"value")
+    db.trim()
+
+    # Trimming goes down to 80% of the maximum, so the two least recently used entries are gone.
+    remaining = [i for i in range(6) if db.get(f"key{i}") is not None]
+    assert remaining == [0, 3, 4, 5]
+
+
+def test_unusable_path_disables_cache(tmp_path: Path) -> None:
+    (tmp_path / "file").write_text("")
+    c = cache.Cache(str(tmp_path / "file" / "cache.sqlite3"))
+    with pytest.warns(UserWarning, match="disabling cache"):
+        assert c.get("key") is None
+    assert c.disabled
+    c.put("key", b"value")
+    assert c.get("key") is None
+
+
+def test_make_key_separates_parts() -> None:
+    assert cache.make_key("ab", "c") != cache.make_key("a", "bc")
+    assert cache.make_key("a") == cache.make_key("a")
+
+
+def test_code_formatter_versions(monkeypatch: pytest.MonkeyPatch) -> None:
+    versions = {"python": "black 1", "go": "gofmt 1", "rust": "rustfmt 1"}
+    monkeypatch.setattr(rstfmt, "code_formatter_version", versions.__getitem__)
+    monkeypatch.setattr(rstfmt, "code_cache", rstfmt.CodeCache())
+    before = rstfmt.code_formatter_versions()
+
+    # An upgraded external formatter has to invalidate cached results for whole files.
+    versions["go"] = "gofmt 2"
+    monkeypatch.setattr(rstfmt, "code_cache", rstfmt.CodeCache())
+    assert rstfmt.code_formatter_versions() != before
@@ -0,0 +1,37 @@
+import pytest
+
+from rstfmt import rst_extras, rstfmt
+
+rst_extras.register()
+
+
+def fmt(text: str) -> str:
+    return rstfmt.format_node(72, rstfmt.parse_string(text))
+
+
+# Directive bodies are formatted as documents of their own, so names defined both inside and outside
+# one (or in two of them) don't clash.
+@pytest.mark.parametrize(
+    "text",
+    [
+        ".. _foo: http://a\n\n.. note::\n\n   .. _foo: http://b\n",
+        ".. _foo: http://a\n\n.. note::\n\n   .. _foo: http://a\n",
+        ".. note::\n\n   .. _foo: http://a\n\n.. tip::\n\n   .. _foo: http://b\n",
+        "A |x|.\n\n.. |x| replace::\n\n   one\n\n.. note::\n\n   B |x|.\n\n"
+        "   .. |x| replace::\n\n      two\n",
+        "A [1]_.\n\n.. [1]\n\n   one\n\n.. note::\n\n   B [1]_.\n\n   .. [1]\n\n      two\n",
+        "A [#]_ [#a]_.\n\n.. [#]\n\n   one\n\n.. [#a]\n\n   one\n\n.. note::\n\n"
+        "   B [#]_ [#a]_.\n\n   .. [#]\n\n      two\n\n   .. [#a]\n\n      two\n",
+    ],
+)
+def test_names_in_directive_bodies(text: str) -> None:
+    assert fmt(text) == text
+
+
+def test_title_styles_in_directive_bodies() -> None:
+    # A section in a body is at the top level of its own document.
+    text = "Outer\n=====\n\n.. note::\n\n   Inner\n   -----\n\n   Text.\n\nMore\n====\n"
+    assert fmt(text) == (
+        "#######\n Outer\n#######\n\n.. note::\n\n   *******\n    Inner\n   *******\n\n   Text.\n\n"
+        "######\n More\n######\n"
+    )
@@ -0,0 +1,113 @@
+import os
+import subprocess
+from pathlib import Path
+from typing import List, Pattern, Sequence
+
+import pytest
+
+from rstfmt import discovery
+
+EXCLUDES = discovery.compile_excludes(None, [])
+
+
+def touch(root: Path, *names: str) -> None:
+    for name in names:
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("text\n")
+
+
+def found(
+    root: Path, extensions: Sequence[str] = ("rst",), excludes: Sequence[Pattern[str]] = EXCLUDES
+) -> List[str]:
+    return [os.path.relpath(p, root) for p in discovery.find_files(str(root), extensions, excludes)]
+
+
+def test_find_files(tmp_path: Path) -> None:
+    touch(
+        tmp_path,
+        "b.rst",
+        "a.rst",
+        "a.txt",
+        "sub/c.rst",
+        "sub/c.rst.bak",
+        "_build/d.rst",
+        "docs/build/e.rst",
+        "docs/building/f.rst",
+        "node_modules/g.rst",
+    )
+    assert found(tmp_path) == ["a.rst", "b.rst", "docs/building/f.rst", "sub/c.rst"]
+    assert found(tmp_path, ["rst", "txt"])[:3] == ["a.rst", "a.txt", "b.rst"]
+
+
+def test_exclude_options(tmp_path: Path) -> None:
+    touch(tmp_path, "a.rst", "_build/b.rst", "generated/c.rst", "sub/generated.rst")
+    excludes = discovery.compile_excludes(None, ["/generated/"])
+    assert found(tmp_path, excludes=excludes) == ["a.rst", "sub/generated.rst"]
+    # Replacing the default brings back what it skipped.
+    excludes = discovery.compile_excludes("/generated", [])
+    assert found(tmp_path, excludes=excludes) == ["a.rst", "_build/b.rst"]
+
+
+def test_hidden_directories_skipped(tmp_path: Path) -> None:
+    touch(tmp_path, "a.rst", ".hidden/b.rst", ".tox/py/c.rst", "sub/.git/d.rst")
+    assert found(tmp_path) == ["a.rst"]
+
+
+def test_symlinked_directories_not_followed(tmp_path: Path) -> None:
+    touch(tmp_path, "real/a.rst")
+    (tmp_path / "link").symlink_to(tmp_path / "real", target_is_directory=True)
+    (tmp_path / "b.rst").symlink_to(tmp_path / "real" / "a.rst")
+    assert found(tmp_path) == ["b.rst", "real/a.rst"]
+
+
+def test_gitignore(tmp_path: Path) -> None:
+    (tmp_path / ".git").mkdir()
+    touch(tmp_path, "a.rst", "skip.rst", "out/b.rst", "docs/c.rst", "docs/d.rst", "docs/e/f.rst")
+    (tmp_path / ".gitignore").write_text("skip.rst\nout/\n")
+    (tmp_path / "docs" / ".gitignore").write_text("d.rst\n/e\n")
+    assert found(tmp_path) == ["a.rst", "docs/c.rst"]
+    # Ignore files above the directory being walked apply too, up to the top of the repository.
+    assert found(tmp_path / "docs") == ["c.rst"]
+    assert discovery.ancestor_ignores(str(tmp_path / "docs" / "e"))[0][0] == str(tmp_path)
+
+
+def test_gitignore_outside_repository(tmp_path: Path) -> None:
+    touch(tmp_path, "skip.rst", "sub/a.rst", "sub/skip.rst")
+    (tmp_path / ".gitignore").write_text("skip.rst\n")
+    # Without a repository, there's nothing tying the parent's ignore file to this directory.
+    assert discovery.ancestor_ignores(str(tmp_path / "sub")) == ()
+    assert found(tmp_path / "sub") == ["a.rst", "skip.rst"]
+
+
+def git(repo: Path, *args: str) -> None:
+    subprocess.run(["git", "-C", str(repo), *args], check=True, stdout=subprocess.DEVNULL)
+
+
+def test_changed_files(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    git(tmp_path, "init", "-q")
+    git(tmp_path, "config", "user.email", "test@example.com")
+    git(tmp_path, "config", "user.name", "Test")
+    touch(tmp_path, "same.rst", "edited.rst", "gone.rst", "sub/same.rst", "sub/edited.rst")
+    (tmp_path / ".gitignore").write_text("ignored.rst\n")
+    git(tmp_path, "add", "-A")
+    git(tmp_path, "commit", "-q", "-m", "base")
+
+    touch(tmp_path, "topnew.rst", "ignored.rst", "notes.txt", "sub/new.rst", ".hidden/new.rst")
+    (tmp_path / "edited.rst").write_text("changed\n")
+    (tmp_path / "sub" / "edited.rst").write_text("changed\n")
+    (tmp_path / "gone.rst").unlink()
+
+    # Untracked files outside the current directory are still found.
+    monkeypatch.chdir(tmp_path / "sub")
+    assert discovery.changed_files("HEAD", [".."], ["rst"], EXCLUDES) == [
+        "../edited.rst",
+        "../topnew.rst",
+        "edited.rst",
+        "new.rst",
+    ]
+    assert discovery.changed_files("HEAD", ["."], ["rst"], EXCLUDES) == ["edited.rst", "new.rst"]
+    assert discovery.changed_files("HEAD", ["../notes.txt"], ["rst"], EXCLUDES) == ["../notes.txt"]
+
+    with pytest.raises(discovery.GitError):
+        discovery.changed_files("no-such-ref", ["."], ["rst"], EXCLUDES)
@@ -0,0 +1,109 @@
+import glob
+import os
+from typing import List, Optional
+
+import docutils
+import pytest
+
+from rstfmt import rst_extras, rstfmt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CORPUS = sorted(glob.glob(os.path.join(ROOT, "tests", "*.rst"))) + [
+    os.path.join(ROOT, "README.rst"),
+    os.path.join(ROOT, "sample.rst"),
+]
+
+rst_extras.register()
+
+
+def read(fn: str) -> str:
+    with open(fn) as f:
+        return f.read()
+
+
+def full(width: Optional[int], text: str) -> Optional[str]:
+    # Some of the edited versions can't be formatted at all (e.g., duplicated targets lose their
+    # names), so there's nothing to compare against.
+    try:
+        return rstfmt.format_node(width, rstfmt.parse_string(text))
+    except (docutils.utils.SystemMessage, IndexError):
+        return None
+
+
+def edits(text: str) -> List[str]:
+    """
+    Return some variations on the text: each of a spread of lines deleted, duplicated, or changed.
+    """
+    lines = text.splitlines(keepends=True)
+    versions = []
+    for i in range(0, len(lines), max(1, len(lines) // 12)):
+        versions.append("".join(lines[:i] + lines[i + 1 :]))
+        versions.append("".join(lines[: i + 1] + lines[i:]))
+        versions.append("".join(lines[:i] + [lines[i].replace(" ", "  ", 1) + "\n"] + lines[i:]))
+    return versions
+
+
+@pytest.mark.parametrize("fn", CORPUS, ids=os.path.basename)
+@pytest.mark.parametrize("width", [30, 72])
+def test_whole_range_matches_full(fn: str, width: int) -> None:
+    text = read(fn)
+    doc = rstfmt.parse_string(text)
+    n = len(text.splitlines())
+    assert rstfmt.format_ranges(width, doc, text, [(1, n)]) == full(width, text)
+
+
+@pytest.mark.parametrize("fn", CORPUS, ids=os.path.basename)
+def test_ranges_of_formatted_text(fn: str) -> None:
+    text = full(72, read(fn))
+    assert text is not None
+    doc = rstfmt.parse_string(text)
+    n = len(text.splitlines())
+    for start in range(1, n + 1, max(1, n // 10)):
+        assert rstfmt.format_ranges(72, doc, text, [(start, start + 3)]) == text
+
+
+def test_range_only_touches_overlapping_elements() -> None:
+    text = "First   paragraph.\n\nSecond   paragraph.\n\n- an   item\n\n- another   item\n"
+    doc = rstfmt.parse_string(text)
+    assert rstfmt.format_ranges(72, doc, text, [(3, 3)]) == (
+        "First   paragraph.\n\nSecond paragraph.\n\n- an   item\n\n- another   item\n"
+    )
+    # The list is formatted as a whole, even when only one item is in the range.
+    assert rstfmt.format_ranges(72, doc, text, [(1, 1), (7, 7)]) == (
+        "First paragraph.\n\nSecond   paragraph.\n\n-  an item\n-  another item\n"
+    )
+
+
+@pytest.mark.parametrize("fn", CORPUS, ids=os.path.basename)
+def test_incremental_matches_full(fn: str) -> None:
+    text = read(fn)
+    inc = rstfmt.IncrementalFormatter(72)
+    assert inc.format(text) == full(72, text)
+
+    for version in edits(text):
+        expected = full(72, version)
+        if expected is None:
+            continue
+        assert inc.format(version) == expected
+        # Going back is also a change.
+        assert inc.format(text) == full(72, text)
+
+
+def test_incremental_edits() -> None:
+    versions = [
+        "Title\n=====\n\nSome text.\n\n- one\n- two\n",
+        # An item added at the end joins the list.
+        "Title\n=====\n\nSome text.\n\n- one\n- two\n\n- three\n",
+        # A paragraph changed in between.
+        "Title\n=====\n\nSome   other text.\n\n- one\n- two\n\n- three\n",
+        # A target added next to another, which get sorted together.
+        "Title\n=====\n\nSome text_.\n\n.. _text: https://b.example\n\n- one\n",
+        "Title\n=====\n\nSome text_ a_.\n\n.. _text: https://b.example\n\n.. _a: https://a\n\n- one\n",
+        # A paragraph turned into the introduction to a literal block.
+        "Title\n=====\n\nSome text::\n\n- one\n",
+        # A new section.
+        "Title\n=====\n\nSome text.\n\nOther\n=====\n\n- one\n",
+    ]
+    inc = rstfmt.IncrementalFormatter(72)
+    for text in versions:
+        assert inc.format(text) == full(72, text)
@@ -0,0 +1,121 @@
+import io
+import json
+import sys
+from typing import List
+
+import pytest
+
+from rstfmt import lsp
+
+Json = lsp.Json
+
+
+def apply_edits(text: str, edits: List[Json]) -> str:
+    # Positions count UTF-16 code units, as editors do.
+    lines = text.splitlines(keepends=True)
+
+    def offset(pos: Json) -> int:
+        before = "".join(lines[: pos["line"]])
+        line = lines[pos["line"]] if pos["line"] < len(lines) else ""
+        units = line.encode("utf-16-le")[: 2 * pos["character"]]
+        return len(before) + len(units.decode("utf-16-le"))
+
+    for edit in sorted(edits, key=lambda e: offset(e["range"]["start"]), reverse=True):
+        start, end = offset(edit["range"]["start"]), offset(edit["range"]["end"])
+        text = text[:start] + edit["newText"] + text[end:]
+    return text
+
+
+@pytest.mark.parametrize(
+    "old,new",
+    [
+        ("a\nb\nc\n", "a\nB\nc\n"),
+        ("a\nb\n", "a\nb\nc\n"),
+        ("a\nb\nc\n", "c\n"),
+        ("", "a\n"),
+        ("a\n", ""),
+        # A last line without a newline ends at a position counted in UTF-16 code units, where
+        # characters outside the BMP take two.
+        ("a\n\U0001d11e b", "a\n\U0001d11e b\n"),
+        ("é\U0001f600x", "é\U0001f600 x\n"),
+    ],
+)
+def test_text_edits(old: str, new: str) -> None:
+    assert apply_edits(old, lsp.text_edits(old, new)) == new
+
+
+def test_text_edits_positions() -> None:
+    edits = lsp.text_edits("a\n\U0001d11e b", "a\n\U0001d11e b\n")
+    assert edits == [
+        {
+            "range": {"start": {"line": 1, "character": 0}, "end": {"line": 1, "character": 4}},
+            "newText": "\U0001d11e b\n",
+        }
+    ]
+
+
+def message(**fields: Json) -> bytes:
+    body = json.dumps({"jsonrpc": "2.0", **fields}).encode("utf-8")
+    return b"Content-Length: %d\r\n\r\n" % len(body) + body
+
+
+def run(data: bytes, monkeypatch: pytest.MonkeyPatch, status: int = 0) -> List[Json]:
+    # `serve` redirects standard output for the rest of the process.
+    monkeypatch.setattr(sys, "stdout", sys.stdout)
+    out = io.BytesIO()
+    assert lsp.serve(72, io.BytesIO(data), out) == status
+    out.seek(0)
+    responses: List[Json] = []
+    while True:
+        response = lsp.read_message(out)
+        if response is None:
+            return responses
+        responses.append(response)
+
+
+def test_session(monkeypatch: pytest.MonkeyPatch, caplog: pytest.LogCaptureFixture) -> None:
+    uri = "file:///doc.rst"
+    bad = b"{not json"
+    data = b"".join(
+        [
+            message(id=1, method="initialize", params={"initializationOptions": {"width": 20}}),
+            message(method="initialized", params={}),
+            b"Content-Length: %d\r\n\r\n" % len(bad) + bad,
+            message(method="$/cancelRequest", params={"id": 1}),
+            message(
+                method="textDocument/didOpen",
+                params={"textDocument": {"uri": uri, "text": "Some  text  here\n"}},
+            ),
+            message(id=2, method="textDocument/formatting", params={"textDocument": {"uri": uri}}),
+            message(id=3, method="$/unknown"),
+            message(id=4, method="shutdown"),
+            message(method="exit"),
+        ]
+    )
+    responses = run(data, monkeypatch)
+
+    assert [r.get("id") for r in responses] == [1, None, 2, 3, 4]
+    assert responses[1]["error"]["code"] == lsp.PARSE_ERROR
+    assert responses[2]["result"] == [
+        {
+            "range": {"start": {"line": 0, "character": 0}, "end": {"line": 1, "character": 0}},
+            "newText": "Some text here\n",
+        }
+    ]
+    assert responses[3]["error"]["code"] == lsp.METHOD_NOT_FOUND
+    assert not caplog.records
+
+
+@pytest.mark.parametrize(
+    "params", [{"initializationOptions": ["width", 20]}, {"initializationOptions": 20}, [20]]
+)
+def test_invalid_initialize(params: Json, monkeypatch: pytest.MonkeyPatch) -> None:
+    data = message(id=1, method="initialize", params=params) + message(method="exit")
+    # Exiting without a shutdown request is an error.
+    responses = run(data, monkeypatch, status=1)
+    assert responses[0]["error"]["code"] == lsp.INVALID_PARAMS
+
+    server = lsp.Server(72)
+    response = server.handle({"jsonrpc": "2.0", "id": 1, "method": "initialize"})
+    assert response is not None and "result" in response
+    assert server.initialized
@@ -0,0 +1,31 @@
+import os
+import subprocess
+import sys
+from concurrent import futures
+from pathlib import Path
+
+import pytest
+
+from rstfmt import debug, rstfmt
+
+
+def test_parse_error_in_worker(tmp_path: Path) -> None:
+    for i in range(5):
+        (tmp_path / f"f{i}.rst").write_text(f"Text {i}.\n")
+    (tmp_path / "f3.rst").write_text(".. foo::\n")
+    proc = subprocess.run(
+        [sys.executable, "-m", "rstfmt", "--check", "--no-cache", "-j", "2", str(tmp_path)],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        encoding="utf-8",
+        env={**os.environ, "PYTHONPATH": os.path.dirname(os.path.dirname(rstfmt.__file__))},
+    )
+    assert proc.returncode != 0
+    assert "BrokenProcessPool" not in proc.stderr
+    assert f'{tmp_path / "f3.rst"}: :1: (ERROR/3) Unknown directive type "foo".' in proc.stderr
+
+
+def test_parse_error_in_width_worker() -> None:
+    with futures.ProcessPoolExecutor(1) as pool:
+        with pytest.raises(rstfmt.ParseError, match="width 30: .*Unknown directive type"):
+            pool.submit(debug._check_source, ".. foo::\n", 30).result()
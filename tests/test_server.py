@@ -0,0 +1,122 @@
+import asyncio
+import json
+import multiprocessing
+from concurrent import futures
+from typing import TYPE_CHECKING, AsyncIterator, Awaitable, Callable
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from aiohttp import web  # noqa: E402
+from aiohttp.test_utils import TestClient, TestServer  # noqa: E402
+
+from rstfmt import server  # noqa: E402
+
+if TYPE_CHECKING:
+    # Only newer versions of aiohttp make this generic.
+    Client = TestClient[web.Request, web.Application]
+else:
+    Client = TestClient
+
+Test = Callable[[Client, server.Limits], Awaitable[None]]
+
+
+def run(test: Test, limits: server.Limits, client_max_size: int = 1024 * 1024) -> None:
+    async def main() -> None:
+        pool = server.WorkerPool(1, warm_up=False, executor="thread")
+        formatter = server.Formatter(pool, cache_size=0)
+        app = server.make_app(formatter, limits, client_max_size)
+        try:
+            async with TestClient(TestServer(app)) as client:
+                await test(client, limits)
+        finally:
+            pool.shutdown()
+
+    asyncio.run(main())
+
+
+def batch(*texts: str) -> str:
+    return json.dumps({"documents": [{"id": i, "text": t} for i, t in enumerate(texts)]})
+
+
+def test_format() -> None:
+    async def test(client: Client, limits: server.Limits) -> None:
+        resp = await client.post("/", data="Some  *text*\n", headers={"X-Line-Length": "40"})
+        assert resp.status == 200
+        assert await resp.text() == "Some *text*\n"
+
+        resp = await client.post("/batch", data=batch("One\n", "Two  words\n"))
+        assert resp.status == 200
+        results = [json.loads(line) for line in (await resp.text()).splitlines()]
+        assert sorted((r["id"], r["text"]) for r in results) == [(0, "One\n"), (1, "Two words\n")]
+
+    run(test, server.Limits())
+
+
+def test_body_too_large() -> None:
+    async def test(client: Client, limits: server.Limits) -> None:
+        resp = await client.post("/", data="x" * 101)
+        assert resp.status == 413
+
+        # Without a Content-Length, the limit applies to what's actually read.
+        async def chunks() -> AsyncIterator[bytes]:
+            for _ in range(3):
+                yield b"x" * 50
+
+        resp = await client.post("/", data=chunks())
+        assert resp.status == 413
+        assert limits.documents == 0
+
+        # Batches only have to fit the application's limit.
+        resp = await client.post("/batch", data=batch("x" * 200))
+        assert resp.status == 200
+        resp = await client.post("/batch", data=batch("x" * 2000))
+        assert resp.status == 413
+
+    run(test, server.Limits(max_body_size=100), client_max_size=1000)
+
+
+def test_overloaded() -> None:
+    async def test(client: Client, limits: server.Limits) -> None:
+        # Stand in for a document that's already being formatted.
+        assert limits.admit()
+        resp = await client.post("/", data="text\n")
+        assert resp.status == 503
+        assert resp.headers["Retry-After"] == "7"
+        resp = await client.post("/batch", data=batch("text\n"))
+        assert resp.status == 503
+        limits.release()
+
+        # A batch bigger than the limit still gets in when nothing else is running.
+        resp = await client.post("/batch", data=batch("a\n", "b\n", "c\n"))
+        assert resp.status == 200
+        assert len((await resp.text()).splitlines()) == 3
+        assert limits.documents == 0
+
+    run(test, server.Limits(max_documents=1, retry_after=7))
+
+
+def test_invalid_requests() -> None:
+    async def test(client: Client, limits: server.Limits) -> None:
+        resp = await client.post("/", data="text\n", headers={"X-Line-Length": "wide"})
+        assert resp.status == 400
+        resp = await client.post("/batch", data=json.dumps({"documents": [{"text": 1}]}))
+        assert resp.status == 400
+        resp = await client.post("/", data="Title\n=====\n\n.. foo::\n\n* a\nb\n")
+        assert resp.status == 400
+        assert resp.reason == ':4: (ERROR/3) Unknown directive type "foo".'
+        assert ".. foo::" in await resp.text()
+
+    run(test, server.Limits())
+
+
+@pytest.mark.parametrize("warm_up", [True, False])
+def test_worker_setup_without_fork(warm_up: bool) -> None:
+    # Spawned workers don't inherit the parent's registered directives and roles.
+    context = multiprocessing.get_context("spawn")
+    with futures.ProcessPoolExecutor(
+        1, mp_context=context, initializer=server.init_worker, initargs=(None, warm_up)
+    ) as pool:
+        result = pool.submit(server.do_format, 72, "See  :py:func:`f`.\n").result()
+    assert result.text == "See :py:func:`f`.\n"